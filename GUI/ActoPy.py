@@ -7,14 +7,24 @@ import numpy as np
 import pyqtgraph as pg
 import sys
 import time
-import struct
-from datetime import datetime, timedelta
+from datetime import timedelta
 import serial
 import threading
 import os.path
 import configparser
 import logging
 
+try:
+    import serialtalk
+except ImportError:
+    # Run from a checkout without pip install ./serial_read
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    os.pardir, 'serial_read'))
+from serialtalk import binfile
+from serialtalk.summary import DailySummary
+from serialtalk.ingest import Ingest, CODECS
+from ringbuffer import RingBuffer
+
 
 class QTextEditLogger(logging.Handler):
     """Text logger class."""
@@ -31,6 +41,41 @@ class QTextEditLogger(logging.Handler):
         self.widget.moveCursor(QtGui.QTextCursor.End)
 
 
+class LiveView(pg.GraphicsLayoutWidget):
+    """Scrolling plots of a RingBuffer, one per channel."""
+
+    def __init__(self, buffer, channels, title, fps=5):
+        """Plot channels ((index, name) pairs), redrawn fps times a second."""
+        super().__init__(title=title)
+        self.buffer = buffer
+        self.curves = []
+        first = None
+        for row, (chan, name) in enumerate(channels):
+            plot = self.addPlot(row=row, col=0,
+                                axisItems={'bottom': pg.DateAxisItem()})
+            plot.setLabel('left', '%d' % (chan+1))
+            plot.setTitle(os.path.basename(name))
+            if first is None:
+                first = plot
+            else:
+                plot.setXLink(first)
+            self.curves.append((chan, plot.plot(pen='r')))
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(int(1000/fps))
+
+    def refresh(self):
+        """Draw straight from the views of the buffer."""
+        times, values = self.buffer.view()
+        for chan, curve in self.curves:
+            curve.setData(times, values[:, chan], connect='finite')
+
+    def closeEvent(self, evnt):
+        self.timer.stop()
+        super().closeEvent(evnt)
+
+
 class serial_read_GUI(QtGui.QMainWindow, QtWidgets.QPlainTextEdit):
     """GUI."""
 
@@ -54,6 +99,10 @@ class serial_read_GUI(QtGui.QMainWindow, QtWidgets.QPlainTextEdit):
                              [RECORDING]
                              active_channels = 
                              channel_names =
+                             summaryfile = ./daily_summary.csv
+                             recordversion = 2
+                             livehours = 48
+                             livesamples = 14400
                              '''
             self.config.read_string(default_config)
             with open('./config.ini', 'w') as configfile:
@@ -66,6 +115,16 @@ class serial_read_GUI(QtGui.QMainWindow, QtWidgets.QPlainTextEdit):
         self.n_pirs = int(self.config['DEFAULT'].get('pirs'))
         self.active_chans = []
         self.state = False
+        self.dropping = False
+
+        # Recent samples and bins for the live views, allocated once
+        recording = self.config['RECORDING']
+        self.live_bins = RingBuffer(
+            self.liveBins(int(self.config['DEFAULT'].get('samplingperiod'))),
+            self.n_pirs)
+        self.live_samples = RingBuffer(int(recording.get('livesamples', '14400')),
+                                       self.n_pirs, dtype=np.uint8)
+        self.live_views = []
 
         self.allowClose = True
 
@@ -136,6 +195,13 @@ class serial_read_GUI(QtGui.QMainWindow, QtWidgets.QPlainTextEdit):
         self.stopbtn.setEnabled(False)
         self.layout.addWidget(self.stopbtn, 7, 6)
 
+        livelayout = QtGui.QHBoxLayout()
+        for label in ('Live bins', 'Live samples'):
+            livebtn = QtGui.QPushButton(label)
+            livebtn.clicked.connect(self.showLive)
+            livelayout.addWidget(livebtn)
+        self.layout.addLayout(livelayout, 8, 6)
+
         self.logTextBox = QTextEditLogger(self)
         self.logTextBox.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S'))
         logging.getLogger().addHandler(self.logTextBox)
@@ -193,6 +259,13 @@ class serial_read_GUI(QtGui.QMainWindow, QtWidgets.QPlainTextEdit):
             if sys._getframe(1).f_code.co_name == 'initUI':
                 raise
 
+    def liveBins(self, winsize=None):
+        """Number of bins of winsize seconds (default: as set) in livehours."""
+        if winsize is None:
+            winsize = int(self.winsize.text())
+        hours = float(self.config['RECORDING'].get('livehours', '48'))
+        return max(int(hours*3600/winsize), 1)
+
     def ReconnectSerial(self):
         try:
             self.ser = serial.Serial(self.port.text(), self.baud.text())
@@ -207,6 +280,9 @@ class serial_read_GUI(QtGui.QMainWindow, QtWidgets.QPlainTextEdit):
 
     @QtCore.pyqtSlot()
     def StartRecord(self):
+        # The bin size may have been changed since the last recording: keep
+        # livehours of bins
+        self.live_bins.resize(self.liveBins())
         lock = threading.Lock()
         with lock:
             self.state = True
@@ -279,65 +355,46 @@ class serial_read_GUI(QtGui.QMainWindow, QtWidgets.QPlainTextEdit):
         In a future version, a new class should be created.
         """
         winsize = timedelta(seconds=int(self.winsize.text()))
+        daily = DailySummary(self.config['RECORDING'].get(
+                                'summaryfile', './daily_summary.csv'))
+        version = int(self.config['RECORDING'].get('recordversion', '2'))
+
+        def on_sample(timestamp, values):
+            self.dropping = False
+            # Monitor + running sums of the current bin
+            self.live_samples.append(timestamp, values)
+            statusmonitor = []
+            for i in self.active_chans:
+                statusmonitor.append('%d: %d' % (i[0]+1, values[i[0]]))
+                self.activity_count[i[0]].setText(
+                                    '%s' % (engine.aggregator.sums[i[0]]))
+            # Monitor output in console
+            print('\t'.join(statusmonitor))
+
+        def on_drop(line, values):
+            # Lines must have one value per PIR of the config ('pirs'), warn
+            # once per run of dropped lines rather than for each of them
+            if values is None or self.dropping:
+                return
+            self.dropping = True
+            print('Dropping serial lines: %d values instead of %d'
+                  % (len(values), self.n_pirs))
+            logging.warning('Dropping serial lines: {} values instead of {}'
+                            .format(len(values), self.n_pirs))
+
+        def on_error(index, filename, error):
+            print('chan %d: incorrect filename' % (index+1))
+            logging.warning('chan {}: incorrect filename'.format(index+1))
+
+        engine = Ingest(CODECS['pir'], lambda: self.active_chans, self.n_pirs,
+                        winsize.total_seconds(), version, summary=daily,
+                        on_sample=on_sample,
+                        on_record=self.live_bins.append,
+                        on_error=on_error, on_drop=on_drop)
         try:
-            # set end of first loop
-            end_loop = datetime.now() + winsize
-
-            # Initialize values list
-            summing_array = [0 for x in range(0, self.n_pirs)]
-            n_reads = 0  # used to calculate average
-
-            # Wait for junk to exit serial
-            t1 = time.time()
-            while time.time() < t1 + 1.5:
-                self.ser.readline()
-
-            # Read ser and write files as long as state is True
-            while self.state:
-                # Read and format serial input
-                in_serial = self.ser.readline()
-                if in_serial == b'':
-                    return
-                cleaned_serial = [int(x, 2) for x
-                                    in in_serial.strip().split(b'\t')]
-                n_reads += 1
-
-                # Monitor + add status to summing_array
-                statusmonitor = []
-                for i in self.active_chans:
-                    summing_array[i[0]] = summing_array[i[0]] \
-                                            + cleaned_serial[i[0]]
-                    statusmonitor.append('%d: %d'
-                                            % (i[0]+1, cleaned_serial[i[0]]))
-                    self.activity_count[i[0]].setText(
-                                                '%s' % (summing_array[i[0]]))
-
-                # Monitor output in console
-                print('\t'.join(statusmonitor))
-
-                # Check if time to write to file, if so write data to files
-                current_time = datetime.now()
-                if current_time >= end_loop:
-                    bin_start = int(time.mktime(current_time.timetuple()))
-                    for n in self.active_chans:
-                        try:
-                            with open(n[1], 'ab') as f:
-                                float_avg = summing_array[n[0]]/n_reads
-                                out_string = struct.pack('=If',
-                                                            bin_start, float_avg)
-                                f.write(out_string)
-                        except FileNotFoundError:
-                            print('chan %d: incorrect filename' % (n[0]+1))
-                            logging.warning('chan {}: incorrect filename'.format(n[0]+1))
-
-                    # Reinitialize values
-                    summing_array = [0 for x in range(0, self.n_pirs)]
-                    n_reads = 0
-
-                    # Set end of next loop
-                    end_loop = current_time + winsize
-            
-            # Terminate the thread if loop is toggled off
+            # Read ser and write files as long as state is True, the
+            # thread terminates when it is toggled off
+            engine.run(self.ser, running=lambda: self.state)
             return
 
         except serial.SerialException:
@@ -350,6 +407,19 @@ class serial_read_GUI(QtGui.QMainWindow, QtWidgets.QPlainTextEdit):
             print('Error: {0}'.format(e) + '\n')
             logging.error('Error: {0}'.format(e) + '\n')
 
+    @QtCore.pyqtSlot()
+    def showLive(self):
+        """Open a scrolling view of the recent bins or samples."""
+        if self.sender().text() == 'Live bins':
+            buffer = self.live_bins
+        else:
+            buffer = self.live_samples
+        view = LiveView(buffer, self.active_chans, self.sender().text())
+        view.show()
+        # Keep a reference, or the window is garbage collected
+        self.live_views = [v for v in self.live_views if v.isVisible()]
+        self.live_views.append(view)
+
     @QtCore.pyqtSlot()
     def drawActogram(self):
         """Draw Actogram for the corresponding channel."""
@@ -359,17 +429,9 @@ class serial_read_GUI(QtGui.QMainWindow, QtWidgets.QPlainTextEdit):
             print('plotting ' + sender)
             sender = int(sender)-1
 
-            time_ = []
-            status = []
-
-            with open(self.name[sender].text(), 'rb') as f:
-                for buff in iter(lambda: f.read(8), b''):
-                    anteroom_tuple = struct.unpack('=If', buff)
-                    time_.append(anteroom_tuple[0])
-                    status.append(anteroom_tuple[1])
-
-            time_ = np.asarray(time_)/(24*3600) + 719163 - 5/24
-            status = np.asarray(status)
+            # Either record format (version 1 or 2)
+            time_, status = binfile.read_bins(self.name[sender].text(), 'pir')
+            time_ = time_/(24*3600) + 719163 - 5/24
 
             days = np.floor(time_)
             x = (time_ - days) * 24
@@ -385,6 +447,19 @@ class serial_read_GUI(QtGui.QMainWindow, QtWidgets.QPlainTextEdit):
                              y[days == i-1] + 1, pen='r')
             self.p1.plot(x[days == int(days[-1])] + 24,          # double-plot
                          y[days == int(days[-1])] + 1, pen='r')  # last day
+
+            # Mark recording gaps (from the session index) on the baselines
+            gap_pen = pg.mkPen('k', width=3)
+            sessions = binfile.read_sessions(self.name[sender].text()) or []
+            for g0, g1 in binfile.gaps(sessions):
+                g0 = g0/(24*3600) + 719163 - 5/24
+                g1 = g1/(24*3600) + 719163 - 5/24
+                for d in range(int(g0), int(g1) + 1):
+                    start = (max(g0, d) - d) * 24
+                    end = (min(g1, d + 1) - d) * 24
+                    self.p1.plot([start, end], [days[-1] - d] * 2, pen=gap_pen)
+                    self.p1.plot([start + 24, end + 24],         # double-plot
+                                 [days[-1] - d + 1] * 2, pen=gap_pen)
             
             # Set axis layout
             self.xax = self.p1.getAxis('bottom')
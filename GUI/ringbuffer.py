@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+# Copyright © 2018 Clément Bourguignon, The Storch Lab, McGill
+# Distributed under terms of the MIT license.
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated circular buffer of timestamped rows, one value per channel.
+
+    Memory is allocated once, so it stays the same over weeks of recording.
+    Every row is written twice, at i and i + capacity, so the last rows are
+    always one contiguous slice: view() hands out numpy views, never copies.
+    Meant for one writer thread (the recorder) and readers that can live
+    with the oldest row being overwritten while they draw.
+    """
+
+    def __init__(self, capacity, n_channels, dtype=np.float32):
+        self.capacity = capacity
+        self.n_channels = n_channels
+        self._times = np.zeros(2*capacity)
+        self._values = np.zeros((2*capacity, n_channels), dtype=dtype)
+        self._next = 0
+        self.count = 0
+
+    def append(self, timestamp, row):
+        """Store one row (sequence of n_channels values) at epoch timestamp."""
+        i = self._next
+        j = i + self.capacity
+        self._times[i] = self._times[j] = timestamp
+        # Element by element: assigning the list as a whole would build a
+        # temporary array for every sample
+        values = self._values
+        for n, value in enumerate(row):
+            values[i, n] = values[j, n] = value
+        # Publish the row only once it is complete
+        self._next = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def resize(self, capacity):
+        """
+            Reallocate for capacity rows, keeping the most recent ones. Not
+            to be called while another thread appends or reads.
+        """
+        if capacity == self.capacity:
+            return
+        times, values = self.view()
+        keep = min(self.count, capacity)
+        new_times = np.zeros(2*capacity)
+        new_values = np.zeros((2*capacity, self.n_channels), dtype=values.dtype)
+        new_times[:keep] = new_times[capacity:capacity+keep] = times[len(times)-keep:]
+        new_values[:keep] = new_values[capacity:capacity+keep] = values[len(values)-keep:]
+        self._times, self._values = new_times, new_values
+        self.capacity = capacity
+        self._next = keep % capacity
+        self.count = keep
+
+    def view(self):
+        """(times, values) of the stored rows, oldest first, as views."""
+        end = self._next + self.capacity
+        start = end - self.count
+        return self._times[start:end], self._values[start:end]
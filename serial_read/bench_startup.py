@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2018 Clément Bourguignon, The Storch Lab, McGill
+# Distributed under terms of the MIT license.
+
+"""
+Check that the recording commands start fast enough.
+
+Each module is imported in a fresh interpreter, several times, and the
+median wall time is compared to a budget. Heavy plotting / analysis
+libraries must not be loaded at import time.
+Usage: python bench_startup.py [--budget 0.5] [--repeat 5]
+"""
+
+import click
+import os
+import subprocess
+import sys
+import time
+
+
+MODULES = ['serial_read', 'serial_read_wheels']
+HEAVY_MODULES = ['numpy', 'pandas', 'matplotlib']
+
+PROBE = """
+import sys
+import {module}
+print(','.join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def import_time(module, repeat):
+    """
+        Median time to start python and import module, and the heavy
+        modules it pulled in.
+    """
+    code = PROBE.format(module=module, heavy=HEAVY_MODULES)
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', code], cwd=here,
+                             check=True, stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout
+        times.append(time.perf_counter()-t1)
+    times.sort()
+    return times[len(times)//2], [m for m in out.strip().split(',') if m]
+
+
+@click.command()
+@click.option('--budget','-b',default=0.5,help="Maximum start-up time in seconds")
+@click.option('--repeat','-r',default=5,help="Number of runs per module")
+def bench(budget,repeat):
+    """
+        Time the import of the recording entry points.
+    """
+    baseline, _ = import_time('sys', repeat)
+    click.echo("python start-up: %.3fs" % baseline)
+    failed = False
+    for module in MODULES:
+        elapsed, heavy = import_time(module, repeat)
+        status = '*'
+        if elapsed > budget or heavy:
+            status = '-'
+            failed = True
+        click.echo("[%s] %s: %.3fs (+%.3fs)%s"
+                   % (status, module, elapsed, elapsed-baseline,
+                      ', loads ' + ', '.join(heavy) if heavy else ''))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    bench()
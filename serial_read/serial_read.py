@@ -12,9 +12,11 @@ import click
 import serial
 from datetime import datetime, timedelta
 import time
-import struct
-import numpy
-import matplotlib.pyplot as plt
+
+from serialtalk import binfile, ingest
+
+# Recording must start fast on the acquisition PCs: numpy, pandas and
+# matplotlib are only imported by the commands that need them.
 
 
 @click.group()
@@ -30,70 +32,76 @@ def cli():
 @click.option('--template','-t',default="pir_n_",help="Initial part of the output name. Numbers get added at the end.\nExample: 'pir_n_'--> pir_n_04")
 @click.option('--winsize','-w',default=60,help="Size of bin window in seconds")
 @click.option('--destructive','-d',default=False,help="Overwrite old files")
-def encode(port,baudrate,n_pir,template,winsize,destructive):
+@click.option('--summary','-S',default=1,help="Keep daily activity summaries in <template>summary.csv, set to 0 to disable")
+@click.option('--version','-V',default=2,type=click.IntRange(1,2),help="Format of new files: 1 (32-bit seconds) or 2 (64-bit milliseconds). Existing files keep their format")
+@click.option('--counts','-c',default=0,help="set to 1 to record the active reads of all PIRs and the number of reads per bin in one compact file, <template>counts (version 2)")
+def encode(port,baudrate,n_pir,template,winsize,destructive,summary,version,counts):
     """
         Open Arduino's serial port and encode incoming message to files.
         Calculates average activity of each bin.
     """
+    codec=ingest.CODECS['pir']
+    channels=None
+    if counts:
+        if version<2:
+            click.echo("[-] Count files need version 2")
+            return
+        codec=ingest.CODECS['pir_count']
+        channels=[(None,template+"counts")]
+    record(codec,port,baudrate,n_pir,template,winsize,destructive,version,
+           template+"summary.csv" if summary else None,
+           echo=lambda now,values: click.echo(values),channels=channels)
+
+
+def record(codec,port,baudrate,n_channels,template,binsize,destructive,version,summary_file=None,echo=None,channels=None):
+    """
+        Body of the encode commands of every sensor: open the serial port
+        and record each channel to <template>NN (or to the given Ingest
+        channels) through an Ingest.
+    """
     template_filename=template+"%02d"
+    if channels is None:
+        channels=[(n,template_filename%(n+1)) for n in range(n_channels)]
     if destructive:
-        for n in range(n_pir):
-            with open(template_filename%(n+1),'wb') as f:
-                f.write()
+        for _,filename in channels:
+            open(filename,'wb').close()
+    daily=None
+    if summary_file:
+        from serialtalk.summary import DailySummary
+        daily=DailySummary(summary_file)
+    # For Epoch time, the minimum bit length to represent the seconds is 31bits --> brings us to 2038
+    # Version 1 files use 32 bits, version 2 files use 64-bit milliseconds (see binfile)
+    dropping=[False]
+    def on_sample(now,values):
+        dropping[0]=False
+        if echo is not None:
+            echo(now,values)
+    def on_drop(line,values):
+        # Warn once per run of lines of the wrong length, garbled lines are
+        # dropped silently
+        if values is None or dropping[0]:
+            return
+        dropping[0]=True
+        click.echo("[-] Dropping serial lines: %i values instead of %i, check -n"%(len(values),n_channels))
+    engine=ingest.Ingest(codec,channels,n_channels,binsize,version,daily,
+                         on_sample=on_sample,on_drop=on_drop)
     try:
-        t1=time.time()
         click.echo("[ ] Serial port")
         ser=serial.Serial(port,baudrate)
         tt1=time.localtime()[:6]
         click.echo("Start time: %04d-%02d-%02d %02d:%02d:%02d."%tt1)
         click.echo("\r[*] Serial port")
         click.echo("[*] Reading stream")
-        # Wait 1.5 second for garbage to get out serial
-        while time.time()-t1<1.5:
-            ser.readline()
     except serial.SerialException:
         click.echo("\r[-] Serial connection error.")
         return
 
-    # Write to multiple files (one per pir)
-    while True:
-        current_time=datetime.now()
-        n_reads=0
-        summing_array=numpy.zeros(n_pir)
-        end_loop=current_time+timedelta(seconds=winsize)
-        while current_time<end_loop:
-            try:
-                in_serial=ser.readline()
-                if in_serial==b'':
-                    continue
-                cleaned_serial=[int(x,2) for x in in_serial.strip().split(b'\t')]
-                if len(cleaned_serial)!=n_pir:
-                    continue
-                click.echo(cleaned_serial)
-                for n in range(n_pir):
-                    summing_array[n]+=cleaned_serial[n]
-                n_reads+=1
-                current_time=datetime.now()
-            except (KeyboardInterrupt,SystemExit):
-                t_end=time.localtime(time.time())[:6]
-                click.echo("\n[C] Exiting")
-                click.echo("[-] Serial connection ended at %04d-%02d-%02d %02d-%02d-%02d"%t_end)
-                return
-            except ValueError:
-                continue
-
-        # Write values to file
-        bin_start=int(time.mktime(current_time.timetuple()))
-        for n in range(n_pir):
-            with open(template_filename%(n+1),'ab') as f:
-                float_avg=summing_array[n]/n_reads
-                out_string=struct.pack('=If',bin_start,float_avg)
-                f.write(out_string)
-
-
-
-            # For Epoch time, the minimum bit length to represent the seconds is 31bits --> brings us to 2038
-            # Use 32 bits == 4 bytes for time representation as bytes is the smallest size to write in using Py
+    try:
+        engine.run(ser)
+    except (KeyboardInterrupt,SystemExit):
+        t_end=time.localtime(time.time())[:6]
+        click.echo("\n[C] Exiting")
+        click.echo("[-] Serial connection ended at %04d-%02d-%02d %02d-%02d-%02d"%t_end)
 
 
 @cli.command()
@@ -102,45 +110,217 @@ def encode(port,baudrate,n_pir,template,winsize,destructive):
 @click.option('--localtime','-l',default=0,help="Output timestamps in local time rather than unix epoch time.\nWARNING: be careful with daylight saving time!")
 @click.option('--draw','-d',default=0,help="set to 1 to display actogram after decoding")
 @click.option('--bin_display','-b',default=0,help="set binsize for actogram display in minutes")
-def decode(n_pir,template,localtime,draw,bin_display):
+@click.option('--session','-s',default=None,type=int,help="Only decode this recording session (0 is the first, -1 the last), see the sessions command")
+@click.option('--counts','-c',default=0,help="set to 1 to decode the count file <template>counts (see encode -c)")
+def decode(n_pir,template,localtime,draw,bin_display,session,counts):
     """
         Decode files that were created with Arduino's serial messages.
+        Both record formats (version 1 and 2) are recognised.
     """
     template_filename=template+"%02d"
 
-    for n in range(n_pir):
-        decode_in_file=template_filename%(n+1)
+    in_files=[template_filename%(n+1) for n in range(n_pir)]
+    if counts:
+        in_files=[template+"counts"]
+    for decode_in_file in in_files:
         decode_out_file=decode_in_file+"_parsed.txt"
         click.echo("Working on file: %s"%decode_out_file)
-        buff_size=8
         try:
-            with open(decode_in_file,'rb') as i: #
-                with open(decode_out_file,'w') as o:
-                    #Header
-                    o.write('Time,Status\n')
-                    while True:
-                        anteroom=i.read(buff_size)
-                        if anteroom==b'':
-                            break
-                        anteroom_tuple=struct.unpack('=If',anteroom)
-                        time_=anteroom_tuple[0]
-                        status=anteroom_tuple[1]
-                        if localtime:
-                            time_=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time_))
-                            o.write('%s,%f\n'%(time_,status))
-                        else:
-                            o.write('%i,%f\n'%(time_,status))
+            selected=None
+            if session is not None:
+                selected=binfile.load_sessions(decode_in_file,'pir')[session]
+            ingest.decode_file(decode_in_file,decode_out_file,ingest.CODECS['pir'],localtime,selected)
         except FileNotFoundError:
             continue
-    if draw:
+        except IndexError:
+            click.echo("[-] No session %i in %s"%(session,decode_in_file))
+            continue
+    if draw and counts:
+        click.echo("[-] Count files are drawn by the render command")
+    elif draw:
         actogram(template_filename, n_pir, bin_display)
 
+
+@cli.command()
+@click.argument('files',nargs=-1,required=True)
+@click.option('--sensor','-s',default="pir",type=click.Choice(['pir','wheel']),help="Type of bin files")
+@click.option('--backup/--no-backup',default=True,help="Keep the original files as <file>.v1")
+def convert(files,sensor,backup):
+    """
+        Convert version 1 bin files to version 2 (64-bit millisecond timestamps).
+        Files are streamed through memory maps, so their size does not matter.
+    """
+    import os
+
+    for filename in files:
+        fmt=binfile.read_format(filename,sensor)
+        if fmt.version>1:
+            click.echo("[ ] %s is already version %i"%(filename,fmt.version))
+            continue
+        t1=time.time()
+        n_records=fmt.count(filename)
+        binfile.convert(filename,filename+".v2",sensor)
+        if backup:
+            os.replace(filename,filename+".v1")
+            os.replace(binfile.index_filename(filename),binfile.index_filename(filename+".v1"))
+        os.replace(filename+".v2",filename)
+        os.replace(binfile.index_filename(filename+".v2"),binfile.index_filename(filename))
+        click.echo("[*] %s: %i records in %.1fs"%(filename,n_records,time.time()-t1))
+
+
+@cli.command()
+@click.argument('files',nargs=-1)
+@click.option('--n_pir','-n',default=10,help="Number of PIRs in serial line (used when no FILES are given)")
+@click.option('--template','-t',default="pir_n_",help="Initial part of the file names (used when no FILES are given)")
+@click.option('--sensor','-s',default="pir",type=click.Choice(['pir','wheel']),help="Type of version 1 bin files (version 2 files record it)")
+@click.option('--binsize','-b',default=0,help="Analysis bin size in seconds, 0 to use the recording bin size (6 minutes for wheel files)")
+@click.option('--min_period',default=20.,help="Shortest period tested, in hours")
+@click.option('--max_period',default=28.,help="Longest period tested, in hours")
+@click.option('--output','-o',default="periodogram.csv",help="Output table, one line per channel")
+@click.option('--spectra',default=False,is_flag=True,help="Also write the full periodograms next to the table")
+@click.option('--plot',default=False,is_flag=True,help="Also save a figure of the periodograms next to the table")
+@click.option('--processes','-j',default=1,help="Number of worker processes for large cohorts")
+def periodogram(files,n_pir,template,sensor,binsize,min_period,max_period,output,spectra,plot,processes):
+    """
+        Chi-square and Lomb-Scargle periodograms of all channels at once.
+    """
+    import os
+    import numpy
+    from serialtalk import periodogram as pg
+
+    if not files:
+        files=[template+"%02d"%(n+1) for n in range(n_pir)]
+    files=[f for f in files if os.path.isfile(f)]
+    if not files:
+        click.echo("[-] No bin file found")
+        return
+
+    t1=time.time()
+    t0,binsize,matrix=pg.bin_matrix(files,sensor,binsize)
+    # Count files hold one channel per PIR of the board
+    channels=[name for f in files for name in binfile.channel_names(f,sensor)]
+    periods=numpy.arange(max(int(min_period*3600//binsize),2),
+                         int(max_period*3600//binsize)+1)
+    click.echo("Analysing %i channels, %i bins of %is, %i periods"
+               %(len(channels),matrix.shape[1],binsize,len(periods)))
+    qp,ls=pg.analyze(matrix,binsize,periods,processes)
+    pg.write_table(output,channels,matrix,binsize,periods,qp,ls)
+
+    stem=os.path.splitext(output)[0]
+    if spectra:
+        pg.write_spectra(stem+"_chi2.csv",channels,binsize,periods,qp)
+        pg.write_spectra(stem+"_ls.csv",channels,binsize,periods,ls)
+    if plot:
+        pg.plot_periodograms(stem+".png",channels,binsize,periods,qp,ls)
+    click.echo("[*] Done in %.1fs, results in %s"%(time.time()-t1,output))
+
+@cli.command()
+@click.argument('files',nargs=-1,required=True)
+@click.option('--sensor','-s',default="pir",type=click.Choice(['pir','wheel']),help="Type of bin files")
+@click.option('--rebuild','-r',default=False,is_flag=True,help="Rebuild the index by scanning the file")
+@click.option('--max_gap','-g',default=0.,help="With --rebuild, start a new session after this many seconds without record (default: 3 times the bin spacing, at least 60s)")
+def sessions(files,sensor,rebuild,max_gap):
+    """
+        List the recording sessions and gaps of bin files, from their index.
+        Files without an index are scanned once to create it.
+    """
+    def clock(t):
+        return time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(t))
+
+    for filename in files:
+        if rebuild:
+            file_sessions=binfile.build_index(filename,sensor,max_gap)
+        else:
+            file_sessions=binfile.load_sessions(filename,sensor)
+        click.echo("%s: %i sessions"%(filename,len(file_sessions)))
+        for n,s in enumerate(file_sessions):
+            click.echo("  %3i  %s -> %s  %8i records  bin %gs"
+                       %(n,clock(s.start),clock(s.end),s.count,s.binsize))
+        for g0,g1 in binfile.gaps(file_sessions):
+            click.echo("  gap  %s -> %s  (%.1f min)"%(clock(g0),clock(g1),(g1-g0)/60))
+
+
+@cli.command()
+@click.option('--pir','-p',multiple=True,help="PIR bin file, can be repeated. Count files give one column per channel, merged exactly from their counts")
+@click.option('--wheel','-w',multiple=True,help="Wheel bin file, can be repeated")
+@click.option('--binsize','-b',default=60.,help="Size of the common time bins in seconds")
+@click.option('--output','-o',default="merged.csv",help="Output file: .csv, or .npy for a matrix with _time.npy and _mask.npy next to it")
+@click.option('--chunk','-c',default=10080,help="Number of bins merged at a time, bounds memory use")
+def merge(pir,wheel,binsize,output,chunk):
+    """
+        Merge PIR and wheel files onto a common time grid, one column per file.
+    """
+    from serialtalk import merge as mg
+
+    sources=[mg.Source(f,'pir') for f in pir]+[mg.Source(f,'wheel') for f in wheel]
+    if not sources:
+        click.echo("[-] No input file, use --pir and/or --wheel")
+        return
+    t1=time.time()
+    if output.endswith('.npy'):
+        mg.merge_to_npy(sources,output,binsize,chunk)
+    else:
+        mg.merge_to_csv(sources,output,binsize,chunk)
+    click.echo("[*] Merged %i files in %.1fs, results in %s"%(len(sources),time.time()-t1,output))
+
+
+@cli.command()
+@click.argument('directories',nargs=-1,required=True)
+@click.option('--pattern','patterns',default=["*_[0-9][0-9]","*counts"],multiple=True,help="Names of the bin files to render, can be repeated (default: channel and count files)")
+@click.option('--sensor','-s',default="pir",type=click.Choice(['pir','wheel']),help="Type of version 1 bin files (version 2 files record it)")
+@click.option('--bin_display','-b',default=30,help="Actogram bin size in minutes")
+@click.option('--format','-f','formats',default=['png'],multiple=True,type=click.Choice(['png','svg','pdf']),help="Output format, can be repeated. pdf gives one multi-page file per directory")
+@click.option('--output','-o',default=None,help="Output directory, mirrors the input tree (default: next to the bin files)")
+@click.option('--processes','-j',default=0,help="Number of worker processes, 0 for one per core")
+def render(directories,patterns,sensor,bin_display,formats,output,processes):
+    """
+        Render actograms of whole experiment directories without a display:
+        one per bin file and a grid per directory (actograms.<format>).
+    """
+    from serialtalk import render as rd
+
+    groups=rd.find_bin_files(directories,patterns)
+    n_files=sum(len(f) for f in groups.values())
+    if not n_files:
+        click.echo("[-] No bin file found")
+        return
+    click.echo("Rendering %i files in %i directories"%(n_files,len(groups)))
+    t1=time.time()
+    rd.render(groups,output,sensor,bin_display,formats,processes,
+              progress=lambda f: click.echo("[*] %s"%f))
+    click.echo("[*] Done in %.1fs"%(time.time()-t1))
+
+
+@cli.command()
+@click.option('--template','-t',default="pir_n_",help="Initial part of the file names (template format)")
+@click.option('--days','-d',default=1,help="Number of days to show")
+def summary(template,days):
+    """
+        Show the daily activity summaries kept by encode.
+    """
+    import os
+    from serialtalk.summary import DailySummary
+
+    summary_filename=template+"summary.csv"
+    if not os.path.isfile(summary_filename):
+        click.echo("[-] No summary file: %s"%summary_filename)
+        return
+    click.echo("%-20s %-10s %10s %7s %8s %8s %8s"
+               %('channel','date','total','active','bout','onset','offset'))
+    for channel,date,day in DailySummary(summary_filename).last_days(days):
+        onset=time.strftime('%H:%M',time.localtime(day[3])) if day[3] else '-'
+        offset=time.strftime('%H:%M',time.localtime(day[4])) if day[4] else '-'
+        click.echo("%-20s %-10s %10.1f %7i %8i %8s %8s"
+                   %(channel,date,day[0],day[1],day[2],onset,offset))
+
 def actogram(template_filename, n_pir, bin_display):
     from datetime import time as ti
+    import numpy
     import pandas as pd
     import matplotlib.pyplot as plt
     import math
 
+    bin_filename = template_filename
     template_filename = template_filename + "_parsed.txt"
 
     nlin = round(math.sqrt(n_pir))
@@ -159,13 +339,13 @@ def actogram(template_filename, n_pir, bin_display):
                     if tmp=='':
                         break
                     tmp=[float(x) for x in tmp.strip().split(',')]
-                    ls_ts.append(datetime.fromtimestamp(int(tmp[0])))
+                    ls_ts.append(datetime.fromtimestamp(tmp[0]))
                     ls_stat.append(tmp[1])
                 PIR_dataframe = pd.DataFrame({'Status':ls_stat}, index=ls_ts)
 
         except ValueError:
             # The date is already converted
-            PIR_dataframe = pd.read_csv(template_filename%(n+1),index_col='time', parse_dates=True)
+            PIR_dataframe = pd.read_csv(template_filename%(n+1),index_col=0, parse_dates=True)
 
         binsize = (PIR_dataframe.index[1]-PIR_dataframe.index[0]).seconds/3600
 
@@ -180,6 +360,9 @@ def actogram(template_filename, n_pir, bin_display):
         n_days=len(days_array)-1
         k=n_days
 
+        # Recording gaps come from the session index, if the file has one
+        bin_gaps = binfile.gaps(binfile.read_sessions(bin_filename%(n+1)) or [])
+
         lin = math.floor((n)/ncol)
         col = (n)%ncol
 
@@ -210,6 +393,11 @@ def actogram(template_filename, n_pir, bin_display):
                 ax[col].fill_between(x, k-1, y+k-1, where=y+k>k, color='black', edgecolor='none')
                 ax[col].fill_between(x+24, k, y+k, where=y+k>k,  color='black', edgecolor='none')
                 ax[col].plot([0,48], [k-1,k-1], color='black')
+            day_start = time.mktime(days_array[i].timetuple())
+            for g0, g1 in binfile.day_spans(bin_gaps, day_start, day_start+24*3600):
+                axis = ax[lin,col] if nlin>1 else ax[col]
+                axis.fill_between([g0, g1], k-1, k, color='lightgrey', edgecolor='none')
+                axis.fill_between([g0+24, g1+24], k, k+1, color='lightgrey', edgecolor='none')
             k-=1
 
         if nlin>1:
@@ -222,8 +410,9 @@ def actogram(template_filename, n_pir, bin_display):
     plt.yticks(numpy.arange(0.5,n_days,1), reversed(days_array[0:-1].strftime("%a %d-%m")))
     plt.ylim(ymax=n_days)
     plt.xlim(xmin=0,xmax=48)
-    plt.show()
+    # Save before showing: once the window is closed the figure is empty
     plt.savefig(template_filename + '.png')
+    plt.show()
 
 """
 To Do:
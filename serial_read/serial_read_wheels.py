@@ -4,9 +4,10 @@
 # Distributed under terms of the MIT license.
 
 import click
-import serial
 import time
-import struct
+
+from serialtalk import binfile, ingest
+from serial_read import record
 
 @click.group()
 def cli():
@@ -21,65 +22,27 @@ def cli():
 @click.option('--template','-t',default="wheel_n_",help="Initial part of the output name. Numbers get added at the end.\nExample: 'pir_n_'--> pir_n_04")
 @click.option('--binsize','-s',default=60,help="Size of bin window in seconds")
 @click.option('--destructive','-d',default=False,help="Overwrite old files")
-def encode(port,baudrate,n_wheels,template,binsize,destructive):
+@click.option('--version','-V',default=2,type=click.IntRange(1,2),help="Format of new files: 1 (32-bit seconds) or 2 (64-bit milliseconds). Existing files keep their format")
+def encode(port,baudrate,n_wheels,template,binsize,destructive,version):
     """
         Open Arduino's serial port and encode incoming message to files
         with a timestamp.
     """
-
-    template_filename=template+"%02d"
-
-    if destructive:
-        for n in range(n_pir):
-            with open(template_filename%(n+1),'wb') as f:
-                f.write()
-
-    try:
-        click.echo("[ ] Serial port")
-        ser = serial.Serial(port, baudrate)
-        tt1 = time.localtime()[:6]
-        click.echo("Start time: %04d-%02d-%02d %02d:%02d:%02d."%tt1)
-        click.echo("\r[*] Serial port")
-        click.echo("[*] Reading stream")
-        # Wait 1.5 second for garbage to get out serial
-        time.sleep(1.5)
-    except serial.SerialException:
-        click.echo("\r[-] Serial connection error.")
-        return
-
-    while True:
-        try:
-            # Get values from serial
-            in_serial = ser.readline()
-            if in_serial == b'':
-                continue
-            cleaned_serial = [int(x, 10) for x in in_serial.strip().split(b'\t')]
-            # Write values to file
-            timestamp = int(time.time())
-            for n in range(len(cleaned_serial)):
-                with open(template_filename%(n+1), 'ab') as f:
-                    rot = cleaned_serial[n]
-                    out_string=struct.pack('=II', timestamp,rot)
-                    f.write(out_string)
-            click.echo([time.strftime("%H:%M:%S", time.localtime())] + cleaned_serial)
-        except (KeyboardInterrupt,SystemExit):
-            t_end=time.localtime(time.time())[:6]
-            click.echo("\n[C] Exiting")
-            click.echo("[-] Serial connection ended at %04d-%02d-%02d %02d-%02d-%02d"%t_end)
-            return
-        except ValueError:
-            continue
+    record(ingest.CODECS['wheel'],port,baudrate,n_wheels,template,binsize,destructive,version,
+           echo=lambda now,values: click.echo([time.strftime("%H:%M:%S",time.localtime(now))]+values))
 
 
 @cli.command()
-@click.option('--n_wheels','-n',default=10,help="Number of PIRs in serial line")
-@click.option('--template','-t',default="pir_n_",help="Initial part of the output name (template format)")
+@click.option('--n_wheels','-n',default=10,help="Number of wheels in serial line")
+@click.option('--template','-t',default="wheel_n_",help="Initial part of the output name (template format)")
 @click.option('--localtime','-l',default=0,help="Output timestamps in local time rather than unix epoch time.\nWARNING: be careful with daylight saving time!")
 @click.option('--draw','-d',default=0,help="set to 1 to display actogram after decoding")
 @click.option('--bin_display','-b',default=0,help="set binsize for actogram display in minutes")
-def decode(n_pir,template,localtime,draw,display_bin):
+@click.option('--session','-s',default=None,type=int,help="Only decode this recording session (0 is the first, -1 the last)")
+def decode(n_wheels,template,localtime,draw,bin_display,session):
     """
         Decode files that were created with Arduino's serial messages.
+        Both record formats (version 1 and 2) are recognised.
     """
 
     template_filename = template + "%02d"
@@ -88,39 +51,30 @@ def decode(n_pir,template,localtime,draw,display_bin):
         decode_in_file = template_filename%(n+1)
         decode_out_file = decode_in_file+"_parsed.txt"
         click.echo('Working on file: %s'%decode_out_file)
-        buff_size = 8
         try:
-            with open(decode_in_file, 'rb') as i: #
-                with open(decode_out_file, 'w') as o:
-                    #Header
-                    o.write('time,Status\n')
-                    while True:
-                        anteroom = i.read(buff_size)
-                        if anteroom == b'':
-                            break
-                        anteroom_tuple = struct.unpack('=II', anteroom)
-                        timestamp = anteroom_tuple[0]
-                        status = anteroom_tuple[1]
-                        if localtime:
-                            timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
-                            o.write('%s,%i\n'%(timestamp,status))
-                        else:
-                            o.write('%i,%i\n'%(timestamp,status))
-
+            selected = None
+            if session is not None:
+                selected = binfile.load_sessions(decode_in_file, 'wheel')[session]
+            ingest.decode_file(decode_in_file, decode_out_file, ingest.CODECS['wheel'], localtime, selected)
         except FileNotFoundError:
             print('File not found')
             continue
+        except IndexError:
+            print('No session %i' % session)
+            continue
 
     if draw:
         actogram(template_filename, n_wheels, bin_display)
 
 
 def actogram(template_filename, n_wheels, bin_display):
-    from datetime import time as ti
+    from datetime import datetime, timedelta, time as ti
+    import numpy
     import pandas as pd
     import matplotlib.pyplot as plt
     import math
 
+    bin_filename = template_filename
     template_filename = template_filename + "_parsed.txt"
 
     nlin = round(math.sqrt(n_wheels))
@@ -138,7 +92,7 @@ def actogram(template_filename, n_wheels, bin_display):
                     tmp=f.readline()
                     if tmp=='':
                         break
-                    tmp=[int(x) for x in tmp.strip().split(',')]
+                    tmp=[float(x) for x in tmp.strip().split(',')]
                     ls_ts.append(datetime.fromtimestamp(tmp[0]))
                     ls_stat.append(tmp[1])
                 f.close()
@@ -146,7 +100,7 @@ def actogram(template_filename, n_wheels, bin_display):
 
         except ValueError:
             # The date is already converted
-            PIR_dataframe = pd.read_csv(template_filename%(n+1),index_col='time', parse_dates=True)
+            PIR_dataframe = pd.read_csv(template_filename%(n+1),index_col=0, parse_dates=True)
 
         binsize = (PIR_dataframe.index[1]-PIR_dataframe.index[0]).seconds/3600
 
@@ -161,6 +115,9 @@ def actogram(template_filename, n_wheels, bin_display):
         n_days=len(days_array)-1
         k=n_days
 
+        # Recording gaps come from the session index, if the file has one
+        bin_gaps = binfile.gaps(binfile.read_sessions(bin_filename%(n+1)) or [])
+
         lin = math.floor((n)/ncol)
         col = (n)%ncol
 
@@ -191,6 +148,11 @@ def actogram(template_filename, n_wheels, bin_display):
                 ax[col].fill_between(x, k-1, y+k-1, where=y+k>k, color='black', edgecolor='none')
                 ax[col].fill_between(x+24, k, y+k, where=y+k>k,  color='black', edgecolor='none')
                 ax[col].plot([0,48], [k-1,k-1], color='black')
+            day_start = time.mktime(days_array[i].timetuple())
+            for g0, g1 in binfile.day_spans(bin_gaps, day_start, day_start+24*3600):
+                axis = ax[lin,col] if nlin>1 else ax[col]
+                axis.fill_between([g0, g1], k-1, k, color='lightgrey', edgecolor='none')
+                axis.fill_between([g0+24, g1+24], k, k+1, color='lightgrey', edgecolor='none')
             k-=1
 
         if nlin>1:
@@ -203,5 +165,6 @@ def actogram(template_filename, n_wheels, bin_display):
     plt.yticks(numpy.arange(0.5,n_days,1), reversed(days_array[0:-1].strftime("%a %d-%m")))
     plt.ylim(ymax=n_days)
     plt.xlim(xmin=0,xmax=48)
-    plt.show()
+    # Save before showing: once the window is closed the figure is empty
     plt.savefig(template_filename + '.png')
+    plt.show()
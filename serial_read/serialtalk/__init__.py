@@ -0,0 +1,7 @@
+"""
+Bin files, ingestion and analyses shared by serialtalk, serialtalkw and
+ActoPy.
+
+Submodules are imported explicitly (from serialtalk import binfile) and this
+package imports nothing itself, so that recorders start fast.
+"""
@@ -0,0 +1,450 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2018 Clément Bourguignon, The Storch Lab, McGill
+# Distributed under terms of the MIT license.
+
+"""
+Read and write the bin files of serialtalk, serialtalkw and ActoPy.
+
+Version 1 files are bare records: a 32-bit unsigned epoch second followed by
+the value ('=If' for PIR bin averages, '=II' for wheel counts). Epoch seconds
+no longer fit in 32 bits after 2038.
+Version 2 files start with a header (magic, version, sensor) and store
+64-bit epoch milliseconds ('=Qf', '=QI').
+Count files ('pir_count', version 2 only) hold every channel of a board: each
+record is the epoch milliseconds, the number of reads in the bin and the
+number of active reads of each channel, all 16-bit ('=QH' + 'H' per channel).
+Activity fractions are count/reads, exactly, and bins can be summed into
+coarser ones without loss (rebin_counts).
+Readers detect the version by themselves; numpy is only imported by the
+functions that return arrays so recorders start fast.
+
+Writers also keep a sidecar index (<file>.idx) with one entry per recording
+session: first and last timestamps, byte range, bin size and record count.
+Readers use it to seek to a session and to find gaps without scanning.
+"""
+
+import os
+import struct
+
+
+MAGIC = b'ACTO'
+# magic, version, sensor code, number of channels per record, padding
+HEADER = struct.Struct('=4sHHH6x')
+SENSOR_CODES = {'pir': 0, 'wheel': 1, 'pir_count': 2}
+SENSORS = {code: sensor for sensor, code in SENSOR_CODES.items()}
+
+RECORD_FORMATS = {
+    1: {'pir': '=If', 'wheel': '=II'},
+    2: {'pir': '=Qf', 'wheel': '=QI', 'pir_count': '=QH%dH'},
+}
+# Sensors whose records hold every channel of a board
+BOARD_SENSORS = ('pir_count',)
+# Sensors written at each read rather than per bin
+UNBINNED_SENSORS = ('wheel',)
+TIME_SCALES = {1: 1, 2: 1000}
+
+INDEX_MAGIC = b'ACTI'
+# magic, index version, padding
+INDEX_HEADER = struct.Struct('=4sH2x')
+# start, end (epoch seconds), byte offsets of the first record and past the
+# last one, bin size (seconds, 0 for unbinned records), number of records
+SESSION = struct.Struct('=ddQQdQ')
+# Shortest gap (seconds) that starts a new session when indexing old files
+MIN_GAP = 60.
+
+
+class BinFormat:
+    """
+    Layout of one bin file: version, sensor and where records start.
+    n_channels only matters for board sensors (one record for all channels).
+    """
+
+    def __init__(self, version=1, sensor='pir', n_channels=1):
+        if sensor not in RECORD_FORMATS[version]:
+            raise ValueError('%s records need version 2 files' % sensor)
+        self.version = version
+        self.sensor = sensor
+        self.n_channels = n_channels if sensor in BOARD_SENSORS else 1
+        self.offset = HEADER.size if version > 1 else 0
+        record_format = RECORD_FORMATS[version][sensor]
+        if sensor in BOARD_SENSORS:
+            record_format = record_format % self.n_channels
+        self.record = struct.Struct(record_format)
+        self.time_scale = TIME_SCALES[version]
+
+    @property
+    def dtype(self):
+        """numpy dtype of one record."""
+        import numpy
+        if self.sensor in BOARD_SENSORS:
+            return numpy.dtype([('time', '=Q'), ('reads', '=H'),
+                                ('counts', '=H', (self.n_channels,))])
+        time_type, status_type = self.record.format.lstrip('=')
+        return numpy.dtype([('time', '=' + time_type),
+                            ('status', '=' + status_type)])
+
+    def header(self):
+        """Bytes written at the beginning of a new file."""
+        if self.version == 1:
+            return b''
+        return HEADER.pack(MAGIC, self.version, SENSOR_CODES[self.sensor],
+                           self.n_channels)
+
+    def stamp(self, timestamp):
+        """
+            Record time of (fractional) epoch seconds: truncated to the
+            second in version 1, as the recorders always did, rounded to the
+            millisecond in version 2.
+        """
+        if self.time_scale == 1:
+            return int(timestamp)
+        return int(round(timestamp*self.time_scale))
+
+    def pack(self, timestamp, value):
+        """
+            Pack one record, timestamp in (fractional) epoch seconds. The
+            value of board sensors is (reads, counts of each channel).
+        """
+        timestamp = self.stamp(timestamp)
+        if self.sensor in BOARD_SENSORS:
+            return self.record.pack(timestamp, value[0], *value[1])
+        return self.record.pack(timestamp, value)
+
+    def count(self, filename):
+        """Number of complete records in filename."""
+        return max(os.path.getsize(filename)-self.offset, 0)//self.record.size
+
+
+def read_format(filename, sensor='pir'):
+    """
+        Detect the format of filename. Files without a header are version 1
+        of the given sensor type, since version 1 does not record it.
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(HEADER.size)
+    if len(head) == HEADER.size and head[:4] == MAGIC:
+        _, version, code, n_channels = HEADER.unpack(head)
+        if code in SENSORS and SENSORS[code] in RECORD_FORMATS.get(version, ()):
+            return BinFormat(version, SENSORS[code], n_channels)
+    return BinFormat(1, sensor)
+
+
+class Session:
+    """
+    One uninterrupted stretch of recording in a bin file.
+    """
+
+    def __init__(self, start, end, offset, end_offset, binsize=0., count=0):
+        self.start = start
+        self.end = end
+        self.offset = offset
+        self.end_offset = end_offset
+        self.binsize = binsize
+        self.count = count
+
+    def pack(self):
+        return SESSION.pack(self.start, self.end, self.offset,
+                            self.end_offset, self.binsize, self.count)
+
+
+def index_filename(filename):
+    return filename + '.idx'
+
+
+def read_sessions(filename):
+    """
+        Sessions of filename from its sidecar index, None if it has none.
+    """
+    try:
+        with open(index_filename(filename), 'rb') as f:
+            head = f.read(INDEX_HEADER.size)
+            body = f.read()
+    except FileNotFoundError:
+        return None
+    if len(head) < INDEX_HEADER.size or head[:4] != INDEX_MAGIC:
+        return None
+    end = len(body)//SESSION.size*SESSION.size
+    return [Session(*entry) for entry in SESSION.iter_unpack(body[:end])]
+
+
+def write_sessions(filename, sessions):
+    """
+        Replace the sidecar index of filename.
+    """
+    with open(index_filename(filename), 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, 1))
+        for session in sessions:
+            f.write(session.pack())
+
+
+def build_index(filename, sensor='pir', max_gap=0, chunk_size=1 << 20):
+    """
+        Scan filename once to create its sidecar index, for files recorded
+        before indexes existed. A new session starts wherever records are
+        more than max_gap seconds apart. By default that is 3 times the
+        median bin spacing, and never less than MIN_GAP: wheel records are
+        single reads, several of them per second in version 1 files.
+        Only chunk_size records are in memory at a time.
+    """
+    import numpy
+    fmt, records = read_records(filename, sensor, mmap=True)
+    binned = fmt.sensor not in UNBINNED_SENSORS
+    sessions = []
+    if len(records):
+        times = records['time']
+
+        def spacing(first, stop):
+            # Median record spacing of the beginning of a stretch
+            t = numpy.asarray(times[first:min(stop, first+10000)], dtype=numpy.float64)
+            return float(numpy.median(numpy.diff(t)))/fmt.time_scale if len(t) > 1 else 0.
+
+        if not max_gap:
+            max_gap = max(3*spacing(0, len(records)), MIN_GAP) if binned else MIN_GAP
+        breaks = []
+        for start in range(0, len(records), chunk_size):
+            # Overlap chunks by one record to see the step across them
+            chunk = numpy.asarray(times[max(start-1, 0):start+chunk_size],
+                                  dtype=numpy.float64)/fmt.time_scale
+            steps = numpy.flatnonzero(numpy.diff(chunk) > max_gap)
+            breaks.extend(steps+max(start-1, 0)+1)
+        bounds = [0] + [int(b) for b in breaks] + [len(records)]
+        size = fmt.record.size
+        for first, stop in zip(bounds[:-1], bounds[1:]):
+            sessions.append(Session(float(times[first])/fmt.time_scale,
+                                    float(times[stop-1])/fmt.time_scale,
+                                    fmt.offset+first*size, fmt.offset+stop*size,
+                                    spacing(first, stop) if binned else 0.,
+                                    stop-first))
+    write_sessions(filename, sessions)
+    return sessions
+
+
+def load_sessions(filename, sensor='pir'):
+    """
+        Sessions of filename, building its index first if it has none or if
+        the index does not cover the whole file.
+    """
+    sessions = read_sessions(filename)
+    if sessions is None or not _index_complete(filename, sessions):
+        sessions = build_index(filename, sensor)
+    return sessions
+
+
+def gaps(sessions):
+    """
+        (last record, next first record) epoch times between sessions.
+    """
+    return [(s.end, n.start) for s, n in zip(sessions[:-1], sessions[1:])]
+
+
+def day_spans(intervals, day_start, day_end):
+    """
+        Parts of the (start, end) epoch intervals within one day, as hours
+        from day_start. Used to draw gaps on actograms.
+    """
+    return [((max(a, day_start)-day_start)/3600, (min(b, day_end)-day_start)/3600)
+            for a, b in intervals if a < day_end and b > day_start]
+
+
+def _index_complete(filename, sessions):
+    size = os.path.getsize(filename)
+    if not sessions:
+        return size <= read_format(filename).offset
+    return sessions[-1].end_offset == size
+
+
+def read_records(filename, sensor='pir', mmap=False, session=None):
+    """
+        Load the raw records of a bin file as a structured array, or map
+        them from disk if mmap is set. With a Session, only its records are
+        read, straight from its offset. A partly written last record (e.g.
+        after a crash) is ignored.
+        Returns (format, records).
+    """
+    import numpy
+    fmt = read_format(filename, sensor)
+    if session is None:
+        offset = fmt.offset
+        count = fmt.count(filename)
+    else:
+        offset = session.offset
+        count = (session.end_offset-session.offset)//fmt.record.size
+    if mmap:
+        if count == 0:
+            return fmt, numpy.empty(0, dtype=fmt.dtype)
+        return fmt, numpy.memmap(filename, dtype=fmt.dtype, mode='r',
+                                 offset=offset, shape=(count,))
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        return fmt, numpy.fromfile(f, dtype=fmt.dtype, count=count)
+
+
+def read_bins(filename, sensor='pir', session=None, channel=0):
+    """
+        Load a bin file (or one Session of it) as two float arrays: epoch
+        timestamps (seconds) and values. For count files, the values are the
+        activity fractions (count/reads) of channel.
+    """
+    import numpy
+    fmt, records = read_records(filename, sensor, session=session)
+    times = records['time'].astype(numpy.float64)
+    if fmt.time_scale != 1:
+        times /= fmt.time_scale
+    if fmt.sensor in BOARD_SENSORS:
+        return times, records['counts'][:, channel]/records['reads']
+    return times, records['status'].astype(numpy.float64)
+
+
+def channel_names(filename, sensor='pir'):
+    """
+        Names of the channels of filename: the file itself, or
+        <file>:NN for each channel of a board (count) file.
+    """
+    fmt = read_format(filename, sensor)
+    if fmt.sensor in BOARD_SENSORS:
+        return ['%s:%02d' % (filename, n+1) for n in range(fmt.n_channels)]
+    return [filename]
+
+
+def read_activity(filename, sensor='pir', channel=0):
+    """
+        Load one channel of a bin file for binning: (sensor, epoch times in
+        seconds, activity, reads). Averages over any bins are the sum of
+        activity over the sum of reads, exact for count files. reads is None
+        for other files, where each record weighs one (PIR bin means are
+        averaged, wheel counts summed).
+    """
+    import numpy
+    fmt, records = read_records(filename, sensor, mmap=True)
+    times = records['time'].astype(numpy.float64)/fmt.time_scale
+    if fmt.sensor in BOARD_SENSORS:
+        return (fmt.sensor, times, records['counts'][:, channel].astype(numpy.float64),
+                records['reads'].astype(numpy.float64))
+    return fmt.sensor, times, records['status'].astype(numpy.float64), None
+
+
+def read_counts(filename, session=None):
+    """
+        Load a count file (or one Session of it): epoch timestamps (seconds),
+        reads per bin (n,) and active reads per bin and channel (n, channels).
+    """
+    fmt, records = read_records(filename, 'pir_count', session=session)
+    if fmt.sensor not in BOARD_SENSORS:
+        raise ValueError('%s is not a count file' % filename)
+    return records['time']/fmt.time_scale, records['reads'], records['counts']
+
+
+def rebin_counts(times, reads, counts, binsize):
+    """
+        Sum count bins into bins of binsize seconds (aligned on epoch time).
+        Sums are exact, so count/reads of the result is the exact fraction of
+        active reads over each coarse bin. Returns (bin start times, reads,
+        counts), with 64-bit sums that no longer fit the 16-bit records.
+    """
+    import numpy
+    if not len(times):
+        return times, reads.astype(numpy.int64), counts.astype(numpy.int64)
+    bins = numpy.floor(times/binsize)
+    # Records are in time order: each coarse bin is one run of records
+    starts = numpy.flatnonzero(numpy.r_[True, bins[1:] != bins[:-1]])
+    return (bins[starts]*binsize,
+            numpy.add.reduceat(reads.astype(numpy.int64), starts),
+            numpy.add.reduceat(counts.astype(numpy.int64), starts, axis=0))
+
+
+class RecordWriter:
+    """
+    Append records to a bin file and keep its session index up to date.
+
+    An existing file keeps its own format whatever version is asked, so that
+    a recording restarted with other settings never mixes layouts. New files
+    get the header of the requested version. The file is opened for each
+    record, as the recorders always did, so data is on disk after each bin.
+    Each writer is one session: its index entry is added at the first record
+    and rewritten in place after each one.
+    """
+
+    def __init__(self, filename, sensor='pir', version=2, binsize=0., n_channels=1):
+        self.filename = filename
+        self.binsize = binsize
+        self.session = None
+        self.session_pos = None
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            self.format = read_format(filename, sensor)
+            if (self.format.sensor in BOARD_SENSORS
+                    and self.format.n_channels != n_channels):
+                raise ValueError('%s has %i channels, not %i' % (
+                    filename, self.format.n_channels, n_channels))
+            # Drop a record cut by a crash, or every later one would be
+            # misaligned
+            size = self.format.offset+self.format.count(filename)*self.format.record.size
+            if os.path.getsize(filename) > size:
+                os.truncate(filename, size)
+            # Files from older versions, or cut between a record and its
+            # index update, get their index rebuilt once
+            load_sessions(filename, sensor)
+        else:
+            self.format = BinFormat(version, sensor, n_channels)
+            # An index left over from an emptied file (encode -d) is stale
+            if os.path.isfile(index_filename(filename)):
+                os.remove(index_filename(filename))
+
+    def write(self, timestamp, value):
+        """Append one record, timestamp in (fractional) epoch seconds."""
+        with open(self.filename, 'ab') as f:
+            if f.tell() == 0:
+                f.write(self.format.header())
+            offset = f.tell()
+            f.write(self.format.pack(timestamp, value))
+        # Index the time as stored, so it agrees with the records and with
+        # an index rebuilt from them
+        self._index(self.format.stamp(timestamp)/self.format.time_scale,
+                    offset, offset+self.format.record.size)
+
+    def _index(self, timestamp, offset, end_offset):
+        if self.session is None:
+            self.session = Session(timestamp, timestamp, offset, end_offset,
+                                   self.binsize, 1)
+            with open(index_filename(self.filename), 'ab') as f:
+                if f.tell() == 0:
+                    f.write(INDEX_HEADER.pack(INDEX_MAGIC, 1))
+                self.session_pos = f.tell()
+                f.write(self.session.pack())
+            return
+        self.session.end = timestamp
+        self.session.end_offset = end_offset
+        self.session.count += 1
+        with open(index_filename(self.filename), 'r+b') as f:
+            f.seek(self.session_pos)
+            f.write(self.session.pack())
+
+
+def convert(filename, out_filename, sensor='pir', version=2, chunk_size=1 << 20):
+    """
+        Rewrite a version 1 file in version 2, with its session index.
+
+        The input is memory-mapped and converted chunk_size records at a
+        time, so memory use does not depend on the size of the file.
+    """
+    import numpy
+    sessions = load_sessions(filename, sensor)
+    fmt, records = read_records(filename, sensor, mmap=True)
+    new_fmt = BinFormat(version, fmt.sensor)
+    scale = new_fmt.time_scale//fmt.time_scale
+    with open(out_filename, 'wb') as o:
+        o.write(new_fmt.header())
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start+chunk_size]
+            out = numpy.empty(len(chunk), dtype=new_fmt.dtype)
+            out['time'] = chunk['time']
+            out['time'] *= scale
+            out['status'] = chunk['status']
+            out.tofile(o)
+
+    def moved(offset):
+        return new_fmt.offset+(offset-fmt.offset)//fmt.record.size*new_fmt.record.size
+    write_sessions(out_filename, [Session(s.start, s.end, moved(s.offset),
+                                          moved(s.end_offset), s.binsize, s.count)
+                                  for s in sessions])
+    return new_fmt
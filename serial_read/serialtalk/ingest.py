@@ -0,0 +1,287 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2018 Clément Bourguignon, The Storch Lab, McGill
+# Distributed under terms of the MIT license.
+
+"""
+Sensor-agnostic ingestion: serial line -> values -> bins -> bin files.
+
+serialtalk, serialtalkw and ActoPy all record through Ingest. What differs
+between sensors lives in a SensorCodec: how a serial line is parsed, how
+reads are aggregated into records and which record layout is written.
+"""
+
+import time
+
+from . import binfile
+
+
+class MeanAggregator:
+    """
+    Average of each channel over the reads of a bin (PIR activity).
+    """
+
+    binned = True
+
+    def __init__(self, n_channels):
+        self.sums = [0]*n_channels
+        self.n_reads = 0
+
+    def add(self, values):
+        sums = self.sums
+        for n in range(len(sums)):
+            sums[n] += values[n]
+        self.n_reads += 1
+
+    def full(self):
+        return False
+
+    def result(self):
+        return [s/self.n_reads for s in self.sums]
+
+    def activity(self):
+        """Value of each channel, for summaries and live views."""
+        return self.result()
+
+    def reset(self):
+        self.sums = [0]*len(self.sums)
+        self.n_reads = 0
+
+
+class CountAggregator(MeanAggregator):
+    """
+    Active reads of each channel and number of reads over a bin (PIR count
+    files). The record is (reads, counts); a bin is closed early rather
+    than overflow the 16-bit fields.
+    """
+
+    MAX_READS = 0xFFFF
+
+    def full(self):
+        return self.n_reads >= self.MAX_READS
+
+    def result(self):
+        if not self.n_reads:
+            return None
+        return self.n_reads, self.sums
+
+    def activity(self):
+        return [s/self.n_reads for s in self.sums]
+
+
+class RawAggregator:
+    """
+    Every read is a record of its own (wheel revolutions).
+    """
+
+    binned = False
+
+    def __init__(self, n_channels):
+        self.values = None
+
+    def add(self, values):
+        self.values = values
+
+    def full(self):
+        return False
+
+    def result(self):
+        return self.values
+
+    def activity(self):
+        return self.values
+
+    def reset(self):
+        self.values = None
+
+
+class SensorCodec:
+    """
+    Everything specific to one sensor type.
+
+    base is the numeral base of the tab-separated serial tokens, aggregator
+    the class turning reads into record values, sensor the record layout in
+    binfile, and value_format / header the text written by decode. Lines
+    that do not have one value per channel are dropped if strict, else the
+    channels present are recorded.
+    """
+
+    def __init__(self, sensor, base, aggregator, value_format, header, strict=True):
+        self.sensor = sensor
+        self.base = base
+        self.aggregator = aggregator
+        self.value_format = value_format
+        self.header = header
+        self.strict = strict
+
+    def parse(self, line):
+        """Values of one serial line, ValueError if it is garbled."""
+        return [int(x, self.base) for x in line.strip().split(b'\t')]
+
+    def header_line(self, fmt):
+        return self.header
+
+    def text(self, fields):
+        """Text of the fields of one record after its time."""
+        return self.value_format % tuple(fields)
+
+
+class CountCodec(SensorCodec):
+    """
+    PIR counts of a whole board in one file: decoded as the number of reads
+    then the active reads of each channel.
+    """
+
+    def header_line(self, fmt):
+        return self.header % ','.join('Count%02d' % (n+1)
+                                      for n in range(fmt.n_channels))
+
+    def text(self, fields):
+        reads, counts = fields
+        return self.value_format % reads + ',' + ','.join(
+            self.value_format % c for c in counts)
+
+
+CODECS = {
+    'pir': SensorCodec('pir', 2, MeanAggregator, '%f', 'Time,Status\n'),
+    # Wheel boards always had their lines recorded whatever their length
+    'wheel': SensorCodec('wheel', 10, RawAggregator, '%i', 'time,Status\n', strict=False),
+    'pir_count': CountCodec('pir_count', 2, CountAggregator, '%i', 'Time,Reads,%s\n'),
+}
+
+
+class Ingest:
+    """
+    Parse serial lines with a codec, aggregate them and write the records.
+
+    channels gives the (index, filename) pairs to record; it can also be a
+    function returning them, read at each record, for channels toggled
+    while recording (ActoPy). Board codecs (pir_count) write every channel
+    to one file, given as (None, filename). Optional hooks:
+        on_sample(timestamp, values) after each parsed line,
+        on_record(timestamp, values) after each written record, with the
+            value of every channel (bin mean for PIR, as in summaries),
+        on_error(index, filename, error) when a file cannot be written,
+        on_drop(line, values) for each line dropped: values is None if it
+            was garbled, else the values of a line of the wrong length,
+    and summary, a DailySummary updated with each record.
+    """
+
+    def __init__(self, codec, channels, n_channels, binsize=60, version=2,
+                 summary=None, on_sample=None, on_record=None, on_error=None,
+                 on_drop=None):
+        self.codec = codec
+        self.channels = channels if callable(channels) else lambda: channels
+        self.n_channels = n_channels
+        self.binsize = binsize
+        self.version = version
+        self.summary = summary
+        self.on_sample = on_sample
+        self.on_record = on_record
+        self.on_error = on_error
+        self.on_drop = on_drop
+        self.aggregator = codec.aggregator(n_channels)
+        self.writers = {}
+        self.end_of_bin = None
+
+    def feed(self, line, now=None):
+        """
+            Process one serial line. Returns its values, or None if it was
+            garbled or, for strict codecs, did not have n_channels values.
+        """
+        try:
+            values = self.codec.parse(line)
+        except ValueError:
+            values = None
+        if values is None or (self.codec.strict and self.n_channels
+                              and len(values) != self.n_channels):
+            if self.on_drop is not None:
+                self.on_drop(line, values)
+            return None
+        if now is None:
+            now = time.time()
+        if self.end_of_bin is None:
+            self.end_of_bin = now+self.binsize
+
+        self.aggregator.add(values)
+        if self.on_sample is not None:
+            self.on_sample(now, values)
+        if (not self.aggregator.binned or now >= self.end_of_bin
+                or self.aggregator.full()):
+            self.flush(now)
+        return values
+
+    def flush(self, now):
+        """Write the aggregated values of every channel at epoch time now."""
+        values = self.aggregator.result()
+        if values is None:
+            return
+        activity = self.aggregator.activity()
+        bin_size = self.binsize if self.aggregator.binned else 0
+        for index, filename in self.channels():
+            if index is not None and index >= len(values):
+                # Channel missing from a short line (non-strict codecs)
+                continue
+            try:
+                writer = self.writers.get(filename)
+                if writer is None:
+                    writer = self.writers[filename] = binfile.RecordWriter(
+                        filename, self.codec.sensor, self.version, bin_size,
+                        self.n_channels)
+                writer.write(now, values if index is None else values[index])
+            except FileNotFoundError as error:
+                if self.on_error is None:
+                    raise
+                self.on_error(index, filename, error)
+                continue
+            if self.summary is None:
+                continue
+            if index is None:
+                for n, value in enumerate(activity):
+                    self.summary.update('%s:%02d' % (filename, n+1), now,
+                                        value, bin_size)
+            else:
+                self.summary.update(filename, now, activity[index], bin_size)
+        if self.summary is not None:
+            self.summary.save()
+        if self.on_record is not None:
+            self.on_record(now, activity)
+        self.aggregator.reset()
+        self.end_of_bin = now+self.binsize
+
+    def run(self, ser, running=lambda: True, purge=1.5):
+        """
+            Read ser line by line while running() is true, after dropping
+            purge seconds of the garbage the Arduino sends when opened.
+        """
+        t1 = time.time()
+        while time.time()-t1 < purge:
+            ser.readline()
+        while running():
+            line = ser.readline()
+            if line == b'':
+                continue
+            self.feed(line)
+
+
+def decode_file(in_filename, out_filename, codec, localtime=False, session=None):
+    """
+        Write a bin file (or one Session of it) as text, 'time,value' lines.
+        Records are mapped from disk and converted a block at a time.
+    """
+    fmt, records = binfile.read_records(in_filename, codec.sensor, mmap=True,
+                                        session=session)
+    if fmt.sensor != codec.sensor:
+        codec = CODECS[fmt.sensor]
+    with open(out_filename, 'w') as o:
+        o.write(codec.header_line(fmt))
+        for start in range(0, len(records), 65536):
+            for time_, *fields in records[start:start+65536].tolist():
+                ms = ''
+                if fmt.time_scale > 1:
+                    # Version 2 timestamps are in milliseconds
+                    ms = '.%03d' % (time_ % 1000)
+                    time_ = time_//1000
+                if localtime:
+                    time_ = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time_))
+                o.write('%s%s,%s\n' % (time_, ms, codec.text(fields)))
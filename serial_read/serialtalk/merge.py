@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2018 Clément Bourguignon, The Storch Lab, McGill
+# Distributed under terms of the MIT license.
+
+"""
+Merge channel files onto a common time grid.
+
+Every file keeps its own timestamps (different boards, restarts...). The
+files are memory-mapped and walked together, one grid chunk at a time: each
+keeps a cursor, the records of the chunk are found with searchsorted and
+aligned to the grid bins with searchsorted again. Only one chunk of the
+(time, channel) matrix is in memory at once.
+
+Count files (binfile 'pir_count') give one column per channel. Their reads
+and active reads are summed over each grid bin, so the fractions of coarser
+grids are exact rather than averages of averages.
+"""
+
+import os
+import numpy
+
+from .binfile import read_records, channel_names, BOARD_SENSORS
+
+
+class Source:
+    """
+    One memory-mapped channel file (or board count file) and its read
+    cursor.
+    """
+
+    def __init__(self, filename, sensor='pir'):
+        self.filename = filename
+        self.format, self.records = read_records(filename, sensor, mmap=True)
+        self.sensor = self.format.sensor
+        self.scale = self.format.time_scale
+        self.cursor = 0
+        self.columns = channel_names(filename, sensor)
+
+    def __len__(self):
+        return len(self.records)
+
+    def first(self):
+        return self.records['time'][0]/self.scale
+
+    def last(self):
+        return self.records['time'][-1]/self.scale
+
+    def take_until(self, end):
+        """
+            Return (times in seconds, values) of the records from the cursor
+            up to epoch time end (excluded), and move the cursor past them.
+            The values of count files are (reads, counts).
+        """
+        times = self.records['time']
+        raw_end = end*self.scale
+        # Gallop to a window that contains end, then searchsorted in it, so
+        # only that window is ever read from disk
+        lo = self.cursor
+        step = 1024
+        while lo+step < len(times) and times[lo+step-1] < raw_end:
+            lo += step
+            step *= 2
+        window = numpy.asarray(times[lo:lo+step])
+        stop = lo+int(numpy.searchsorted(window, raw_end, side='left'))
+
+        chunk = self.records[self.cursor:stop]
+        self.cursor = stop
+        times = chunk['time'].astype(numpy.float64)/self.scale
+        if self.sensor in BOARD_SENSORS:
+            return times, (chunk['reads'], chunk['counts'])
+        return times, chunk['status'].astype(numpy.float64)
+
+
+def grid_bounds(sources, binsize):
+    """
+        First grid time (aligned on binsize) and number of bins covering
+        all sources.
+    """
+    sources = [s for s in sources if len(s)]
+    if not sources:
+        raise ValueError('No records in the input files')
+    start = min(s.first() for s in sources)//binsize*binsize
+    end = max(s.last() for s in sources)
+    return start, int((end-start)//binsize)+1
+
+
+def merge(sources, binsize, chunk_bins=10080):
+    """
+        Merge sources onto a grid of binsize seconds, chunk_bins bins at a
+        time. PIR records falling in the same bin are averaged, wheel counts
+        are summed, count files give the active reads over the reads of the
+        bin.
+        Yields (times, values, missing) per chunk: grid times (n,), values
+        (n, columns) with NaN where missing, and the missing mask.
+    """
+    start, n_bins = grid_bounds(sources, binsize)
+    n_columns = sum(len(s.columns) for s in sources)
+    for source in sources:
+        source.cursor = 0
+    for chunk_start in range(0, n_bins, chunk_bins):
+        n = min(chunk_bins, n_bins-chunk_start)
+        edges = start+(chunk_start+numpy.arange(n+1))*binsize
+        values = numpy.full((n, n_columns), numpy.nan)
+        missing = numpy.ones((n, n_columns), dtype=bool)
+        c = 0
+        for source in sources:
+            cols = slice(c, c+len(source.columns))
+            c = cols.stop
+            times, status = source.take_until(edges[-1])
+            if not len(times):
+                continue
+            idx = numpy.searchsorted(edges, times, side='right')-1
+            # Records written after a clock change may be out of order
+            keep = (idx >= 0) & (idx < n)
+            if source.sensor in BOARD_SENSORS:
+                reads, active = status[0][keep], status[1][keep]
+                reads = numpy.bincount(idx[keep], weights=reads, minlength=n)
+                active = numpy.stack([numpy.bincount(idx[keep], weights=a, minlength=n)
+                                      for a in active.T], axis=1)
+                present = reads > 0
+                values[present, cols] = active[present]/reads[present, None]
+                missing[:, cols] = ~present[:, None]
+                continue
+            if not keep.all():
+                idx, status = idx[keep], status[keep]
+            sums = numpy.bincount(idx, weights=status, minlength=n)
+            counts = numpy.bincount(idx, minlength=n)
+            present = counts > 0
+            if source.sensor == 'pir':
+                values[present, cols.start] = sums[present]/counts[present]
+            else:
+                values[present, cols.start] = sums[present]
+            missing[:, cols.start] = ~present
+        yield edges[:-1], values, missing
+
+
+def merge_to_csv(sources, output, binsize, chunk_bins=10080):
+    """
+        Write the merged matrix as CSV, one column per file. Missing values
+        are left empty.
+    """
+    integral = float(binsize).is_integer()
+    with open(output, 'w') as o:
+        o.write('time,' + ','.join(c for s in sources for c in s.columns) + '\n')
+        for times, values, missing in merge(sources, binsize, chunk_bins):
+            for t, row, gaps in zip(times, values.tolist(), missing.tolist()):
+                o.write(('%i' if integral else '%.3f') % t + ','
+                        + ','.join('' if g else '%g' % v
+                                   for v, g in zip(row, gaps)) + '\n')
+
+
+def merge_to_npy(sources, output, binsize, chunk_bins=10080):
+    """
+        Write the merged matrix to .npy files mapped from disk: the values
+        (float32, NaN where missing) in output, the grid times and the
+        missing mask next to it (<output>_time.npy, <output>_mask.npy).
+    """
+    from numpy.lib.format import open_memmap
+
+    start, n_bins = grid_bounds(sources, binsize)
+    stem = os.path.splitext(output)[0]
+    shape = (n_bins, sum(len(s.columns) for s in sources))
+    values_out = open_memmap(output, mode='w+', dtype=numpy.float32, shape=shape)
+    mask_out = open_memmap(stem+'_mask.npy', mode='w+', dtype=bool, shape=shape)
+    time_out = open_memmap(stem+'_time.npy', mode='w+', dtype=numpy.float64,
+                           shape=(n_bins,))
+    row = 0
+    for times, values, missing in merge(sources, binsize, chunk_bins):
+        values_out[row:row+len(times)] = values
+        mask_out[row:row+len(times)] = missing
+        time_out[row:row+len(times)] = times
+        row += len(times)
+    for out in (values_out, mask_out, time_out):
+        out.flush()
@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2018 Clément Bourguignon, The Storch Lab, McGill
+# Distributed under terms of the MIT license.
+
+"""
+Circadian period analysis of many channels at once.
+
+All channels are binned onto a common time grid, giving a (channels, bins)
+matrix, and every periodogram is computed on the whole matrix with NumPy.
+Very large cohorts can be split across a process pool by channel blocks.
+"""
+
+import os
+import numpy
+from concurrent.futures import ProcessPoolExecutor
+
+from .binfile import channel_names, read_activity
+
+
+# Upper quantile of the standard normal distribution for alpha=0.01
+Z_99 = 2.3263478740408408
+
+# Default analysis bin (seconds) of wheel files, which hold one record per
+# read rather than bins
+WHEEL_BINSIZE = 360
+
+# Number of frequencies evaluated together by lomb_scargle, bounds the size
+# of the (frequencies, bins) trigonometric tables
+LS_CHUNK = 32
+
+
+def bin_matrix(filenames, sensor='pir', binsize=0):
+    """
+        Bin every channel of every file onto one common time grid, one row
+        per channel in the order of binfile.channel_names.
+
+        PIR bins are averaged, wheel counts are summed and count files give
+        the exact fraction of active reads; the sensor of each file is read
+        from its header, sensor is only used for version 1 files. Bins
+        without any record are NaN. If binsize is 0 it is the median spacing
+        of the PIR bins, or WHEEL_BINSIZE when there are only wheel files
+        (their records are single reads, not bins).
+        Returns (grid start time, binsize in seconds, matrix).
+    """
+    series = [read_activity(f, sensor, k) for f in filenames
+              for k in range(len(channel_names(f, sensor)))]
+    series_times = [t for _, t, _, _ in series if len(t)]
+    if not series_times:
+        raise ValueError('No records in the input files')
+
+    if not binsize:
+        binned = [t for s, t, _, _ in series if s != 'wheel' and len(t) > 1]
+        if binned:
+            binsize = float(numpy.median(numpy.concatenate(
+                [numpy.diff(t[:10000]) for t in binned])))
+            binsize = max(round(binsize), 1)
+        else:
+            binsize = WHEEL_BINSIZE
+
+    t0 = min(t[0] for t in series_times)//binsize*binsize
+    n_bins = int((max(t[-1] for t in series_times)-t0)//binsize)+1
+
+    flat_idx = []
+    flat_val = []
+    flat_reads = []
+    for n, (_, t, v, reads) in enumerate(series):
+        flat_idx.append(n*n_bins+((t-t0)//binsize).astype(numpy.int64))
+        flat_val.append(v)
+        flat_reads.append(numpy.ones(len(t)) if reads is None else reads)
+    flat_idx = numpy.concatenate(flat_idx)
+    flat_val = numpy.concatenate(flat_val)
+    flat_reads = numpy.concatenate(flat_reads)
+
+    size = len(series)*n_bins
+    sums = numpy.bincount(flat_idx, weights=flat_val, minlength=size).reshape(-1, n_bins)
+    reads = numpy.bincount(flat_idx, weights=flat_reads, minlength=size).reshape(-1, n_bins)
+    wheel = numpy.array([s == 'wheel' for s, _, _, _ in series])[:, None]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        matrix = numpy.where(wheel, numpy.where(reads > 0, sums, numpy.nan),
+                             sums/reads)
+    return t0, binsize, matrix
+
+
+def chi_square(matrix, periods):
+    """
+        Sokolove-Bushell chi-square periodogram of every row of matrix.
+
+        periods are in bins. Missing bins (NaN) are left out of the row and
+        column means. Returns Qp as a (channels, periods) array.
+    """
+    valid = ~numpy.isnan(matrix)
+    data = numpy.where(valid, matrix, 0.)
+    n_chan, n_bins = data.shape
+
+    # Column sums run once per period and dominate the cost: use compact
+    # types for them, the totals below stay in float64
+    data32 = data.astype(numpy.float32)
+    valid8 = valid.view(numpy.uint8)
+    count_type = numpy.uint16 if n_bins < 2**17 else numpy.uint32
+
+    # Prefix sums give the total variance of any truncated record in O(1)
+    zeros = numpy.zeros((n_chan, 1))
+    cum_n = numpy.hstack((zeros, numpy.cumsum(valid, axis=1)))
+    cum_x = numpy.hstack((zeros, numpy.cumsum(data, axis=1)))
+    cum_x2 = numpy.hstack((zeros, numpy.cumsum(data*data, axis=1)))
+
+    qp = numpy.full((n_chan, len(periods)), numpy.nan)
+    for j, p in enumerate(periods):
+        n_rows = n_bins//p
+        if n_rows < 2:
+            continue
+        length = n_rows*p
+        n = cum_n[:, length]
+        mean = cum_x[:, length]/n
+        total_ss = cum_x2[:, length]-n*mean*mean
+
+        col_sum = data32[:, :length].reshape(n_chan, n_rows, p).sum(axis=1)
+        col_n = numpy.add.reduce(valid8[:, :length].reshape(n_chan, n_rows, p),
+                                 axis=1, dtype=count_type)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            col_mean = col_sum/col_n
+            col_ss = numpy.nansum((col_mean-mean[:, None])**2, axis=1)
+            qp[:, j] = (n/p)*n*col_ss/total_ss
+    return qp
+
+
+def chi_square_threshold(periods):
+    """
+        Qp significance threshold (alpha=0.01) for each period, using the
+        Wilson-Hilferty approximation of the chi-square quantile.
+    """
+    dof = numpy.asarray(periods, dtype=numpy.float64)-1
+    h = 2/(9*dof)
+    return dof*(1-h+Z_99*numpy.sqrt(h))**3
+
+
+def lomb_scargle(matrix, binsize, periods):
+    """
+        Normalised Lomb-Scargle spectrum of every row of matrix.
+
+        Missing bins (NaN) are excluded, so interrupted recordings do not
+        need to be interpolated. periods are in bins.
+        Returns the power as a (channels, periods) array.
+    """
+    valid = ~numpy.isnan(matrix)
+    w = valid.astype(numpy.float64)
+    n = w.sum(axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.where(valid, matrix, 0.).sum(axis=1)/n
+        y = numpy.where(valid, matrix-mean[:, None], 0.)
+        var = (y*y).sum(axis=1)/(n-1)
+
+    t = numpy.arange(matrix.shape[1])*float(binsize)
+    omega = 2*numpy.pi/(numpy.asarray(periods, dtype=numpy.float64)*binsize)
+
+    power = numpy.empty((matrix.shape[0], len(omega)))
+    for start in range(0, len(omega), LS_CHUNK):
+        wt = numpy.outer(omega[start:start+LS_CHUNK], t)
+        s2 = w @ numpy.sin(2*wt).T
+        c2 = w @ numpy.cos(2*wt).T
+        ys = y @ numpy.sin(wt).T
+        yc = y @ numpy.cos(wt).T
+
+        # Phase offset tau so that sine and cosine terms are orthogonal
+        two_wtau = numpy.arctan2(s2, c2)
+        cos_wtau = numpy.cos(two_wtau/2)
+        sin_wtau = numpy.sin(two_wtau/2)
+        r = numpy.hypot(s2, c2)
+
+        y_cos = yc*cos_wtau+ys*sin_wtau
+        y_sin = ys*cos_wtau-yc*sin_wtau
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            cos_term = numpy.where(n[:, None]+r > 0, y_cos**2/((n[:, None]+r)/2), 0.)
+            sin_term = numpy.where(n[:, None]-r > 0, y_sin**2/((n[:, None]-r)/2), 0.)
+            power[:, start:start+LS_CHUNK] = (cos_term+sin_term)/(2*var[:, None])
+    return power
+
+
+def _analyze_block(args):
+    """
+        Worker for analyze: both periodograms of one block of channels.
+    """
+    matrix, binsize, periods = args
+    return chi_square(matrix, periods), lomb_scargle(matrix, binsize, periods)
+
+
+def analyze(matrix, binsize, periods, processes=1, block_size=16):
+    """
+        Compute the chi-square periodogram and Lomb-Scargle spectrum of every
+        channel of matrix. With processes > 1 the channels are split in
+        blocks of block_size and spread over a process pool.
+        Returns (Qp, LS power), both (channels, periods) arrays.
+    """
+    if processes <= 1 or matrix.shape[0] <= block_size:
+        return _analyze_block((matrix, binsize, periods))
+
+    blocks = [(matrix[i:i+block_size], binsize, periods)
+              for i in range(0, matrix.shape[0], block_size)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        results = list(pool.map(_analyze_block, blocks))
+    return (numpy.vstack([r[0] for r in results]),
+            numpy.vstack([r[1] for r in results]))
+
+
+def write_table(output, filenames, matrix, binsize, periods, qp, ls):
+    """
+        Write one line per channel with the peak of each periodogram.
+    """
+    hours = numpy.asarray(periods)*binsize/3600
+    threshold = chi_square_threshold(periods)
+    with open(output, 'w') as o:
+        o.write('file,n_bins,coverage,chi2_period,chi2_qp,chi2_significant,'
+                'ls_period,ls_power\n')
+        for n, name in enumerate(filenames):
+            coverage = numpy.mean(~numpy.isnan(matrix[n]))
+            if numpy.all(numpy.isnan(qp[n])) or numpy.all(numpy.isnan(ls[n])):
+                o.write('%s,%i,%.3f,,,,,\n' % (name, matrix.shape[1], coverage))
+                continue
+            i = numpy.nanargmax(qp[n])
+            j = numpy.nanargmax(ls[n])
+            o.write('%s,%i,%.3f,%.3f,%.2f,%i,%.3f,%.4f\n'
+                    % (name, matrix.shape[1], coverage, hours[i], qp[n, i],
+                       qp[n, i] > threshold[i], hours[j], ls[n, j]))
+
+
+def write_spectra(output, filenames, binsize, periods, values):
+    """
+        Write a full periodogram, one column per channel.
+    """
+    hours = numpy.asarray(periods)*binsize/3600
+    with open(output, 'w') as o:
+        o.write('period,' + ','.join(filenames) + '\n')
+        for j, h in enumerate(hours):
+            o.write('%.4f,' % h + ','.join('%g' % v for v in values[:, j]) + '\n')
+
+
+def plot_periodograms(output, filenames, binsize, periods, qp, ls):
+    """
+        Save a grid of periodograms, one panel per channel.
+    """
+    import math
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    hours = numpy.asarray(periods)*binsize/3600
+    threshold = chi_square_threshold(periods)
+    n_chan = len(filenames)
+    nlin = round(math.sqrt(n_chan))
+    ncol = math.ceil(math.sqrt(n_chan))
+    fig, ax = plt.subplots(nlin, ncol, sharex='all', squeeze=False,
+                           figsize=(3*ncol, 2*nlin))
+    for n in range(n_chan):
+        a = ax[n//ncol, n % ncol]
+        a.plot(hours, qp[n], color='black', linewidth=0.8)
+        a.plot(hours, threshold, color='grey', linestyle='--', linewidth=0.8)
+        a2 = a.twinx()
+        a2.plot(hours, ls[n], color='red', linewidth=0.8)
+        a2.set_yticks([])
+        a.set_title(os.path.basename(filenames[n]), fontsize=8)
+    for n in range(n_chan, nlin*ncol):
+        ax[n//ncol, n % ncol].axis('off')
+    fig.tight_layout()
+    fig.savefig(output)
+    plt.close(fig)
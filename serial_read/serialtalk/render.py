@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2018 Clément Bourguignon, The Storch Lab, McGill
+# Distributed under terms of the MIT license.
+
+"""
+Headless batch rendering of actograms.
+
+Figures are drawn with matplotlib's Agg canvas, without pyplot, so no display
+is needed and workers never share a global figure state. Each channel is
+binned and drawn in its own process; the binned days are sent back and the
+grid and multi-page PDF of every directory are drawn by the same pool.
+"""
+
+import fnmatch
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+
+from . import binfile
+
+
+SKIPPED_EXTENSIONS = ('.idx', '.txt', '.csv', '.png', '.svg', '.pdf', '.npy',
+                      '.tmp', '.v1', '.v2')
+
+
+# Channel files (pir_n_04) and board count files (pir_n_counts)
+BIN_PATTERNS = ('*_[0-9][0-9]', '*counts')
+
+
+def find_bin_files(directories, patterns=BIN_PATTERNS):
+    """
+        Bin files under directories (recursively) whose name matches one of
+        patterns, grouped by directory.
+    """
+    if isinstance(patterns, str):
+        patterns = (patterns,)
+    found = {}
+    for top in directories:
+        for root, _, files in os.walk(top):
+            names = sorted(f for f in files
+                           if any(fnmatch.fnmatch(f, p) for p in patterns)
+                           and not f.endswith(SKIPPED_EXTENSIONS))
+            if names:
+                found[root] = [os.path.join(root, f) for f in names]
+    return found
+
+
+def local_seconds(times):
+    """
+        Epoch seconds shifted to local time, the UTC offset being looked up
+        once per hour of recording (daylight saving time changes included).
+    """
+    hours = numpy.floor(times/3600).astype(numpy.int64)
+    unique_hours, inverse = numpy.unique(hours, return_inverse=True)
+    offsets = numpy.array([time.localtime(h*3600).tm_gmtoff for h in unique_hours.tolist()])
+    return times+offsets[inverse]
+
+
+def day_matrix(filename, sensor='pir', bin_minutes=30, channel=0):
+    """
+        Bin one channel of a file into a (days, bins per day) matrix of
+        local days. PIR values are averaged, wheel counts summed, count files
+        give the fraction of active reads; empty bins are NaN.
+        Returns (first day as epoch of its local midnight, matrix).
+    """
+    sensor, times, values, reads = binfile.read_activity(filename, sensor, channel)
+    if not len(times):
+        return None, numpy.empty((0, 24*60//bin_minutes))
+    local = local_seconds(times)
+    binsize = bin_minutes*60
+    per_day = 24*3600//binsize
+    first_day = numpy.floor(local[0]/86400)*86400
+    idx = ((local-first_day)//binsize).astype(numpy.int64)
+    n_days = int(idx[-1]//per_day)+1
+    keep = (idx >= 0) & (idx < n_days*per_day)
+    idx, values = idx[keep], values[keep]
+    sums = numpy.bincount(idx, weights=values, minlength=n_days*per_day)
+    counts = numpy.bincount(idx, weights=None if reads is None else reads[keep],
+                            minlength=n_days*per_day)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        if sensor != 'wheel':
+            matrix = sums/counts
+        else:
+            matrix = numpy.where(counts > 0, sums, numpy.nan)
+    # Back to the epoch of the first local midnight
+    first_day = first_day-(local[0]-times[0])
+    return first_day, matrix.reshape(n_days, per_day)
+
+
+def draw_actogram(ax, first_day, matrix, gaps=(), title=''):
+    """
+        Double-plotted actogram of a day matrix on a matplotlib axis, newest
+        day at the bottom as in serial_read.actogram. Gaps are greyed.
+    """
+    from matplotlib.collections import PolyCollection
+
+    n_days, per_day = matrix.shape
+    top = numpy.nanmax(matrix) if n_days and numpy.any(matrix > 0) else 1
+    heights = numpy.nan_to_num(matrix)/top*0.9
+
+    # One step-shaped polygon per day and half, all in a single collection:
+    # far lighter than one fill_between per row for weeks of recording
+    edges = numpy.arange(per_day+1)*24/per_day
+    xs = numpy.concatenate(([0], numpy.repeat(edges, 2)[1:-1], [24]))
+    base = (n_days-1-numpy.arange(n_days))[:, None]
+    ys = numpy.hstack((base, base+numpy.repeat(heights, 2, axis=1), base))
+    polygons = numpy.empty((2*n_days, len(xs), 2))
+    polygons[:n_days, :, 0] = xs
+    polygons[:n_days, :, 1] = ys
+    polygons[n_days:, :, 0] = xs+24                 # double-plot
+    polygons[n_days:, :, 1] = ys+1
+    ax.add_collection(PolyCollection(polygons, facecolors='black', linewidths=0))
+    ax.hlines(numpy.arange(n_days), 0, 48, color='black', linewidth=0.5)
+
+    k = n_days
+    for i in range(n_days):
+        day_start = first_day+i*86400
+        for g0, g1 in binfile.day_spans(gaps, day_start, day_start+86400):
+            ax.fill_between([g0, g1], k-1, k, color='lightgrey', linewidth=0)
+            ax.fill_between([g0+24, g1+24], k, k+1, color='lightgrey', linewidth=0)
+        k -= 1
+
+    ax.set_xticks(range(0, 49, 6))
+    ax.set_xticklabels(['00:00', '06:00', '12:00', '18:00']*2+['00:00'], fontsize=6)
+    days = [time.strftime('%a %d-%m', time.localtime(first_day+i*86400+43200))
+            for i in range(n_days)]
+    ax.set_yticks(numpy.arange(0.5, n_days, 1))
+    ax.set_yticklabels(list(reversed(days)), fontsize=6)
+    ax.set_xlim(0, 48)
+    ax.set_ylim(0, max(n_days, 1))
+    ax.set_title(title, fontsize=8)
+
+
+def new_figure(width, height):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(width, height))
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def render_channel(args):
+    """
+        Worker: bin one channel of a file, save its actogram in every format
+        asked (png, svg) and return what the grid and PDF need.
+    """
+    filename, channel, name, sensor, bin_minutes, out_stem, formats = args
+    first_day, matrix = day_matrix(filename, sensor, bin_minutes, channel)
+    gaps = binfile.gaps(binfile.read_sessions(filename) or [])
+    if first_day is not None:
+        fig = new_figure(6, 1+0.25*len(matrix))
+        draw_actogram(fig.add_subplot(1, 1, 1), first_day, matrix, gaps,
+                      os.path.basename(name))
+        fig.tight_layout()
+        for fmt in formats:
+            if fmt != 'pdf':
+                fig.savefig(out_stem+'.'+fmt)
+    return name, first_day, matrix, gaps
+
+
+def draw_grid(channels):
+    """Figure with the actograms of all channels of a directory."""
+    nlin = round(math.sqrt(len(channels)))
+    ncol = math.ceil(math.sqrt(len(channels)))
+    n_days = max(len(c[2]) for c in channels)
+    grid = new_figure(4*ncol, (1+0.15*n_days)*nlin)
+    for n, (filename, first_day, matrix, gaps) in enumerate(channels):
+        draw_actogram(grid.add_subplot(nlin, ncol, n+1), first_day, matrix,
+                      gaps, os.path.basename(filename))
+    grid.tight_layout()
+    return grid
+
+
+def render_directory(args):
+    """
+        Worker: save the grid of all channels of a directory in every format
+        asked, pdf giving the grid on the first page then one page per
+        channel.
+    """
+    out_stem, channels, formats = args
+    channels = [c for c in channels if c[1] is not None]
+    if not channels:
+        return out_stem
+    grid = draw_grid(channels)
+    for fmt in formats:
+        if fmt != 'pdf':
+            grid.savefig(out_stem+'.'+fmt)
+
+    if 'pdf' in formats:
+        from matplotlib.backends.backend_pdf import PdfPages
+        with PdfPages(out_stem+'.pdf') as pdf:
+            pdf.savefig(grid)
+            for filename, first_day, matrix, gaps in channels:
+                fig = new_figure(8.27, 11.69)
+                draw_actogram(fig.add_subplot(1, 1, 1), first_day, matrix,
+                              gaps, os.path.basename(filename))
+                pdf.savefig(fig)
+    return out_stem
+
+
+def render(groups, out_dir=None, sensor='pir', bin_minutes=30,
+           formats=('png',), processes=0, progress=None):
+    """
+        Render every group of files ({directory: [files]}, see
+        find_bin_files): one actogram per file (per channel for count
+        files) and, per directory, a grid
+        (actograms.<format>). Files are spread over processes workers (0:
+        one per core). Outputs go next to the files, or mirror the directory
+        tree under out_dir.
+
+        The grids and the PDF of a directory are drawn by the same workers
+        as soon as its last file is binned, the PDF apart from the images,
+        while the other directories are still being processed.
+    """
+    # Absolute paths, or commonpath fails on a mix of absolute and relative
+    # directories and gives '' for siblings such as . and ../b
+    top = os.path.commonpath([os.path.abspath(d) for d in groups]) if groups else '.'
+
+    def stem(path):
+        if out_dir is None:
+            return path
+        return os.path.join(out_dir, os.path.relpath(os.path.abspath(path), top))
+
+    image_formats = tuple(f for f in formats if f != 'pdf')
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+        jobs = {}
+        names = {}
+        for directory, files in groups.items():
+            names[directory] = []
+            for filename in files:
+                os.makedirs(os.path.dirname(stem(filename)) or '.', exist_ok=True)
+                # Count files: one actogram per channel of the board
+                channels = binfile.channel_names(filename, sensor)
+                for channel, name in enumerate(channels):
+                    out_stem = stem(filename)
+                    if len(channels) > 1:
+                        out_stem += '_%02d' % (channel+1)
+                    names[directory].append(name)
+                    jobs[pool.submit(render_channel, (filename, channel, name, sensor,
+                                                      bin_minutes, out_stem,
+                                                      image_formats))] = directory
+
+        done = {directory: {} for directory in groups}
+        directory_jobs = []
+        for future in as_completed(jobs):
+            result = future.result()
+            if progress is not None:
+                progress(result[0])
+            directory = jobs[future]
+            done[directory][result[0]] = result
+            if len(done[directory]) < len(names[directory]):
+                continue
+            channels = [done[directory][name] for name in names[directory]]
+            out_stem = os.path.join(stem(directory), 'actograms')
+            if image_formats:
+                directory_jobs.append(pool.submit(
+                    render_directory, (out_stem, channels, image_formats)))
+            if 'pdf' in formats:
+                directory_jobs.append(pool.submit(
+                    render_directory, (out_stem, channels, ('pdf',))))
+        for job in directory_jobs:
+            job.result()
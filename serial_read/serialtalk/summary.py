@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2018 Clément Bourguignon, The Storch Lab, McGill
+# Distributed under terms of the MIT license.
+
+"""
+Daily activity summaries kept up to date while recording.
+"""
+
+import os
+import time
+
+
+class DailySummary:
+    """
+    Per-channel, per-day activity aggregates, updated bin by bin.
+
+    For each channel and local day it keeps the total activity, the number
+    of active bins, the longest bout (consecutive active bins) and onset /
+    offset estimates: the start of the first and the end of the last bout of
+    at least min_bout bins. Each update costs the same whatever the length
+    of the recording, and the raw bin files are never read back.
+
+    In the file, the rows of past days come first and are only appended
+    once, when the day is over; save() rewrites the rows of the current day
+    alone, so it does not slow down as the recording grows.
+    """
+
+    header = 'channel,date,total,active_bins,longest_bout,onset,offset\n'
+
+    def __init__(self, filename, threshold=0., min_bout=3):
+        self.filename = filename
+        self.threshold = threshold
+        self.min_bout = min_bout
+        # date -> channel -> [total, active_bins, longest_bout, onset, offset]
+        self.days = {}
+        # channel -> [bout start, bout length, date] of the ongoing bout
+        self.bouts = {}
+        # Most recent date, the only one rewritten by save()
+        self.current = None
+        # Past dates not in the file yet
+        self.closed = []
+        # Byte offset of the rows of the current date, None before the
+        # first save (which writes the whole file)
+        self.offset = None
+        if os.path.isfile(filename):
+            self.load()
+
+    def update(self, channel, timestamp, value, binsize=0.):
+        """
+            Add one bin of channel ending at epoch timestamp and lasting
+            binsize seconds (0 for single reads).
+        """
+        date = time.strftime('%Y-%m-%d', time.localtime(timestamp))
+        if self.current is None or date > self.current:
+            if self.current is not None:
+                self.closed.append(self.current)
+            self.current = date
+        elif date < self.current:
+            # Clock set back: that day is already in the file, rewrite it all
+            self.offset = None
+        channels = self.days.get(date)
+        if channels is None:
+            channels = self.days[date] = {}
+        day = channels.get(channel)
+        if day is None:
+            day = channels[channel] = [0., 0, 0, None, None]
+        day[0] += value
+
+        if value <= self.threshold:
+            self.bouts.pop(channel, None)
+            return
+        day[1] += 1
+        bout = self.bouts.get(channel)
+        # Bouts are cut at midnight so each day stands on its own
+        if bout is None or bout[2] != date:
+            bout = self.bouts[channel] = [timestamp-binsize, 0, date]
+        bout[1] += 1
+        if bout[1] > day[2]:
+            day[2] = bout[1]
+        if bout[1] >= self.min_bout:
+            if day[3] is None:
+                day[3] = bout[0]
+            day[4] = timestamp
+
+    def save(self):
+        """
+            Append the days that are over and rewrite the current one. The
+            first save rewrites the whole file, atomically.
+        """
+        if self.offset is None:
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'wb') as o:
+                o.write(self.header.encode())
+                for date in sorted(self.days):
+                    if date != self.current:
+                        o.write(self._rows(date))
+                self.offset = o.tell()
+                o.write(self._rows(self.current))
+            os.replace(tmp_filename, self.filename)
+            self.closed = []
+            return
+        with open(self.filename, 'r+b') as o:
+            o.seek(self.offset)
+            for date in self.closed:
+                o.write(self._rows(date))
+            self.offset = o.tell()
+            o.write(self._rows(self.current))
+            o.truncate()
+        self.closed = []
+
+    def _rows(self, date):
+        return ''.join('%s,%s,%g,%i,%i,%s,%s\n'
+                       % (channel, date, day[0], day[1], day[2],
+                          _clock(day[3]), _clock(day[4]))
+                       for channel, day in sorted(self.days.get(date, {}).items())
+                       ).encode()
+
+    def load(self):
+        """Resume from an existing summary file, e.g. after a restart."""
+        with open(self.filename, 'r') as f:
+            f.readline()
+            for line in f:
+                channel, date, total, active, longest, onset, offset = \
+                    line.rstrip('\n').rsplit(',', 6)
+                self.days.setdefault(date, {})[channel] = [
+                    float(total), int(active), int(longest),
+                    _epoch(date, onset), _epoch(date, offset)]
+        if self.days:
+            self.current = max(self.days)
+
+    def last_days(self, n_days=1):
+        """Rows of the n_days most recent days, sorted by channel."""
+        dates = sorted(self.days)[-n_days:]
+        return sorted((channel, date, day) for date in dates
+                      for channel, day in self.days[date].items())
+
+
+def _clock(timestamp):
+    if timestamp is None:
+        return ''
+    return time.strftime('%H:%M:%S', time.localtime(timestamp))
+
+
+def _epoch(date, clock):
+    if not clock:
+        return None
+    return time.mktime(time.strptime(date + ' ' + clock, '%Y-%m-%d %H:%M:%S'))
@@ -8,6 +8,7 @@ setup(
         description='Open Arduino''s serial port and encode incoming message to files',
         license = "MIT",
         py_modules=['serial_read', 'serial_read_wheels'],
+        packages=['serialtalk'],
         install_requires=['Click','pyserial', 'numpy', 'pandas', 'matplotlib'],
         entry_points='''
             [console_scripts]
@@ -0,0 +1,62 @@
+"""
+Board count files ('pir_count'): one '=QH%dH' record per bin for all PIRs.
+"""
+
+import struct
+
+from serialtalk import binfile, ingest
+
+
+T0 = 1700000000
+
+
+def count_engine(filename, n_channels=3, binsize=60):
+    return ingest.Ingest(ingest.CODECS['pir_count'], [(None, filename)],
+                         n_channels, binsize=binsize)
+
+
+def test_count_records(tmp_path):
+    filename = str(tmp_path / 'pir_n_counts')
+    engine = count_engine(filename)
+    for now, line in ((T0, b'1\t0\t1\n'), (T0+30, b'0\t0\t1\n'),
+                      (T0+60, b'1\t0\t0\n')):
+        engine.feed(line, now=now)
+    with open(filename, 'rb') as f:
+        assert f.read() == (struct.pack('=4sHHH6x', b'ACTO', 2, 2, 3)
+                            + struct.pack('=QH3H', (T0+60)*1000, 3, 2, 0, 2))
+    fmt = binfile.read_format(filename)
+    assert (fmt.sensor, fmt.n_channels, fmt.record.format) == ('pir_count', 3, '=QH3H')
+
+
+def test_bin_closed_before_reads_overflow(tmp_path):
+    filename = str(tmp_path / 'pir_n_counts')
+    engine = count_engine(filename, binsize=3600)
+    engine.feed(b'1\t1\t0\n', now=T0)
+    # Jump to the last read that fits in 16 bits
+    engine.aggregator.n_reads = 0xFFFE
+    engine.aggregator.sums = [0xFFFE, 7, 0]
+    engine.feed(b'1\t0\t0\n', now=T0+1)
+    engine.feed(b'1\t1\t1\n', now=T0+2)
+    times, reads, counts = binfile.read_counts(filename)
+    assert times.tolist() == [T0+1]
+    assert reads.tolist() == [0xFFFF]
+    assert counts.tolist() == [[0xFFFF, 7, 0]]
+    # The next bin starts afresh
+    assert engine.aggregator.n_reads == 1
+
+
+def test_read_bins_exact_fractions(tmp_path):
+    filename = str(tmp_path / 'pir_n_counts')
+    writer = binfile.RecordWriter(filename, 'pir_count', 2, 60, 2)
+    rows = [(600, (1, 599)), (599, (3, 200)), (7, (7, 0))]
+    for k, (reads, counts) in enumerate(rows):
+        writer.write(T0+60*k, (reads, counts))
+    for channel in range(2):
+        times, values = binfile.read_bins(filename, channel=channel)
+        assert times.tolist() == [T0+60*k for k in range(3)]
+        assert values.tolist() == [c[channel]/r for r, c in rows]
+    # Coarser bins are exact sums
+    t, r, c = binfile.read_counts(filename)
+    _, reads, counts = binfile.rebin_counts(t, r, c, 3600)
+    assert reads.tolist() == [1206]
+    assert counts.tolist() == [[11, 799]]
@@ -0,0 +1,182 @@
+"""
+Ingest against the on-disk formats: records must stay byte-exact with what
+the recorders wrote before it (version 1) and with binfile (version 2).
+"""
+
+import os
+import struct
+import time
+
+import pytest
+
+from serialtalk import binfile, ingest
+
+
+T0 = 1700000000
+
+
+def record_pir(path, version):
+    """Three reads of a 60 s PIR bin on 3 channels, then the first of the next."""
+    files = [str(path / ('pir_n_%02d' % (n+1))) for n in range(3)]
+    engine = ingest.Ingest(ingest.CODECS['pir'], list(enumerate(files)), 3,
+                           binsize=60, version=version)
+    for now, line in ((T0, b'1\t0\t1\n'), (T0+30, b'0\t0\t1\n'),
+                      (T0+60, b'1\t0\t0\n'), (T0+90, b'1\t1\t1\n')):
+        engine.feed(line, now=now)
+    return files
+
+
+def record_wheel(path, version):
+    files = [str(path / ('wheel_n_%02d' % (n+1))) for n in range(2)]
+    engine = ingest.Ingest(ingest.CODECS['wheel'], list(enumerate(files)), 2,
+                           binsize=60, version=version)
+    for k, line in enumerate((b'3\t0\n', b'12\t7\n')):
+        engine.feed(line, now=T0+k)
+    return files
+
+
+def test_pir_v1_records(tmp_path):
+    files = record_pir(tmp_path, 1)
+    # One bin, stamped at its end, holding the mean of its 3 reads
+    means = (2/3, 0., 2/3)
+    for filename, mean in zip(files, means):
+        with open(filename, 'rb') as f:
+            assert f.read() == struct.pack('=If', T0+60, mean)
+
+
+def test_pir_v2_records(tmp_path):
+    files = record_pir(tmp_path, 2)
+    header = struct.pack('=4sHHH6x', b'ACTO', 2, 0, 1)
+    for filename, mean in zip(files, (2/3, 0., 2/3)):
+        with open(filename, 'rb') as f:
+            assert f.read() == header + struct.pack('=Qf', (T0+60)*1000, mean)
+
+
+def test_wheel_v1_records(tmp_path):
+    files = record_wheel(tmp_path, 1)
+    with open(files[0], 'rb') as f:
+        assert f.read() == struct.pack('=II', T0, 3) + struct.pack('=II', T0+1, 12)
+    with open(files[1], 'rb') as f:
+        assert f.read() == struct.pack('=II', T0, 0) + struct.pack('=II', T0+1, 7)
+
+
+def test_wheel_v2_records(tmp_path):
+    files = record_wheel(tmp_path, 2)
+    header = struct.pack('=4sHHH6x', b'ACTO', 2, 1, 1)
+    with open(files[0], 'rb') as f:
+        assert f.read() == (header + struct.pack('=QI', T0*1000, 3)
+                            + struct.pack('=QI', (T0+1)*1000, 12))
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_decode_pir(tmp_path, version):
+    files = record_pir(tmp_path, version)
+    out = str(tmp_path / 'out.txt')
+    ingest.decode_file(files[0], out, ingest.CODECS['pir'])
+    with open(out) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'Time,Status'
+    time_, status = lines[1].split(',')
+    assert float(time_) == T0+60
+    assert float(status) == pytest.approx(2/3)
+    assert len(lines) == 2
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_decode_wheel(tmp_path, version):
+    files = record_wheel(tmp_path, version)
+    out = str(tmp_path / 'out.txt')
+    ingest.decode_file(files[1], out, ingest.CODECS['wheel'])
+    with open(out) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'time,Status'
+    assert [(float(t), int(v)) for t, v in (l.split(',') for l in lines[1:])] \
+        == [(T0, 0), (T0+1, 7)]
+
+
+def test_wrong_length_lines_dropped(tmp_path):
+    files = [str(tmp_path / 'pir_n_01'), str(tmp_path / 'pir_n_02')]
+    dropped = []
+    engine = ingest.Ingest(ingest.CODECS['pir'], list(enumerate(files)), 2,
+                           binsize=60, on_drop=lambda line, values: dropped.append(values))
+    assert engine.feed(b'1\t1\t1\n', now=T0) is None
+    assert engine.feed(b'1\n', now=T0+10) is None
+    assert engine.feed(b'x\t1\n', now=T0+20) is None
+    assert engine.feed(b'1\t0\n', now=T0+30) == [1, 0]
+    assert engine.feed(b'1\t1\n', now=T0+90) == [1, 1]
+    assert dropped == [[1, 1, 1], [1], None]
+    # Only the two good reads made it into the bin
+    times, values = binfile.read_bins(files[1])
+    assert times.tolist() == [T0+90]
+    assert values.tolist() == [0.5]
+
+
+def test_v1_times_truncated(tmp_path):
+    # Version 1 recorders always stored int(time.time()): a read at .7 s
+    # belongs to its own second, not the next one
+    filename = str(tmp_path / 'wheel_n_01')
+    engine = ingest.Ingest(ingest.CODECS['wheel'], [(0, filename)], 1, version=1)
+    engine.feed(b'5\n', now=T0+0.7)
+    engine.feed(b'6\n', now=T0+1.2)
+    with open(filename, 'rb') as f:
+        assert f.read() == struct.pack('=II', T0, 5) + struct.pack('=II', T0+1, 6)
+
+
+def test_v2_times_rounded_to_ms(tmp_path):
+    filename = str(tmp_path / 'wheel_n_01')
+    engine = ingest.Ingest(ingest.CODECS['wheel'], [(0, filename)], 1, version=2)
+    engine.feed(b'5\n', now=T0+0.2346)
+    with open(filename, 'rb') as f:
+        assert f.read()[16:] == struct.pack('=QI', T0*1000+235, 5)
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_index_matches_records(tmp_path, version):
+    filename = str(tmp_path / 'wheel_n_01')
+    engine = ingest.Ingest(ingest.CODECS['wheel'], [(0, filename)], 1, version=version)
+    for k in range(5):
+        engine.feed(b'1\n', now=T0+k+0.7)
+    session, = binfile.read_sessions(filename)
+    times, _ = binfile.read_bins(filename, 'wheel')
+    assert (session.start, session.end) == (times[0], times[-1])
+    rebuilt, = binfile.build_index(filename, 'wheel')
+    assert (rebuilt.start, rebuilt.end, rebuilt.count) == \
+        (session.start, session.end, session.count)
+
+
+def test_short_wheel_lines_recorded(tmp_path):
+    # 8 wheels on a board recorded with the default -n 10
+    files = [str(tmp_path / ('wheel_n_%02d' % (n+1))) for n in range(10)]
+    dropped = []
+    engine = ingest.Ingest(ingest.CODECS['wheel'], list(enumerate(files)), 10,
+                           on_drop=lambda line, values: dropped.append(values))
+    assert engine.feed(b'\t'.join([b'2']*8) + b'\n', now=T0) == [2]*8
+    assert dropped == []
+    assert binfile.read_bins(files[7], 'wheel')[1].tolist() == [2]
+    assert not os.path.exists(files[8])
+
+
+def test_encode_warns_once_per_run_of_dropped_lines(tmp_path, monkeypatch):
+    import serial
+    import serial_read
+    from click.testing import CliRunner
+
+    lines = [b'1\t0\n', b'1\t0\n', b'1\t0\t1\n', b'1\t0\n']
+
+    class Port:
+        opened = time.time()
+
+        def readline(self):
+            # Nothing during the 1.5 s purge of the recorder
+            if time.time() < self.opened+1.6:
+                time.sleep(0.01)
+                return b''
+            if not lines:
+                raise KeyboardInterrupt
+            return lines.pop(0)
+
+    monkeypatch.setattr(serial, 'Serial', lambda port, baudrate: Port())
+    monkeypatch.chdir(str(tmp_path))
+    result = CliRunner().invoke(serial_read.cli, ['encode', '-n', '3', '-S', '0'])
+    # Two runs of dropped lines, split by a good one
+    assert result.output.count('Dropping serial lines: 2 values instead of 3') == 2
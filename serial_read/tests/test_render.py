@@ -0,0 +1,40 @@
+import os
+
+from serialtalk import binfile, render
+
+
+T0 = 1700000000
+
+
+def make_file(filename):
+    writer = binfile.RecordWriter(filename, 'pir', 2, 1800)
+    for k in range(96):
+        writer.write(T0+1800*k, k % 2)
+
+
+def test_output_mirrors_sibling_and_absolute_directories(tmp_path, monkeypatch):
+    for d in ('a', 'b'):
+        os.mkdir(str(tmp_path / d))
+        make_file(str(tmp_path / d / 'pir_n_01'))
+    monkeypatch.chdir(str(tmp_path / 'a'))
+    # Relative siblings, then a mix of absolute and relative directories
+    for directories, out in ((['.', '../b'], '../out1'),
+                             ([str(tmp_path / 'a'), '../b'], '../out2')):
+        render.render(render.find_bin_files(directories), out, processes=1)
+        for d in ('a', 'b'):
+            assert os.path.isfile(str(tmp_path / out[3:] / d / 'pir_n_01.png'))
+            assert os.path.isfile(str(tmp_path / out[3:] / d / 'actograms.png'))
+    assert not os.path.exists(str(tmp_path / 'b' / 'pir_n_01.png'))
+
+
+def test_count_files_rendered_per_channel(tmp_path):
+    filename = str(tmp_path / 'pir_n_counts')
+    writer = binfile.RecordWriter(filename, 'pir_count', 2, 1800, 2)
+    for k in range(96):
+        writer.write(T0+1800*k, (100, (k % 2*100, 50)))
+    make_file(str(tmp_path / 'pir_n_01'))
+    groups = render.find_bin_files([str(tmp_path)])
+    assert groups == {str(tmp_path): [str(tmp_path / 'pir_n_01'), filename]}
+    render.render(groups, processes=1)
+    for name in ('pir_n_counts_01.png', 'pir_n_counts_02.png', 'actograms.png'):
+        assert os.path.isfile(str(tmp_path / name))